@@ -0,0 +1,72 @@
+"""
+Synthetic station data generator, the csv files follow the logger
+(TOA5) format: a header line, the columns names, the units and the
+processing (Smp) lines and one data row per minute. A small fraction
+of the values are the logger junk values (-99, INF, NAN).
+"""
+import os
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+
+from spectroman.const import calib_columns
+
+# logger junk values, see data.clean_df
+junk_values = ['-99', 'INF', 'NAN']
+
+def spectra_rows(rng, n):
+    """
+    Return n (Batt, Temp_Box, Tens_Pira, CalibData) rows, the spectra
+    are smooth radiometric curves with noise.
+    """
+    wl = np.linspace(0, 1, 166)
+    # ed is brighter than lu and ld, day light changes along the rows
+    light = 0.5 + rng.random((n, 1))
+    scale = np.array([1.0, 0.05, 0.05, 0.2, 0.2])
+    blocks = [s * light * (1.0 + np.sin(np.pi * wl)) +
+              0.01 * rng.standard_normal((n, 166)) for s in scale]
+    head = np.column_stack([12.0 + rng.random(n),
+                            30.0 + 5 * rng.random(n),
+                            rng.random(n)])
+    return np.hstack([head] + blocks)
+
+def write_csv(fname, start, rows=1440, seed=0, junk=0.001):
+    """
+    Write a csv of rows (one per minute) from start (datetime), a
+    fraction (junk) of the values are logger junk values.
+    """
+    rng = np.random.default_rng(seed)
+    cols = ['TIMESTAMP', 'RECORD', 'Batt', 'Temp_Box', 'Tens_Pira']
+    units = ['TS', 'RN', 'Volts', 'Deg C', 'mV']
+    ts = pd.date_range(start, periods=rows, freq='min')\
+        .strftime('%Y-%m-%d %H:%M:%S')
+    values = spectra_rows(rng, rows).round(5).astype(str)
+    mask = rng.random(values.shape) < junk
+    values[mask] = rng.choice(junk_values, mask.sum())
+
+    with open(fname, 'w') as f:
+        f.write('"TOA5","spectroman","CR1000","1","CR1000.Std.32",'
+                '"CPU:spectroman.CR1","1","Table"\n')
+        f.write(','.join(f'"{c}"' for c in cols + calib_columns) + '\n')
+        f.write(','.join(f'"{u}"' for u in units) +
+                ',""' * len(calib_columns) + '\n')
+        f.write('"",""' + ',"Smp"' * (len(cols) - 2 + len(calib_columns))
+                + '\n')
+        for i in range(rows):
+            f.write(f'"{ts[i]}",{i},' + ','.join(values[i]) + '\n')
+    return fname
+
+def write_days(path, start, days, rows=1440, junk=0.001):
+    """
+    Write one csv per day (named as the logger files, day first) into
+    path, the files already written are kept. Return the files list.
+    """
+    os.makedirs(path, exist_ok=True)
+    files = []
+    for i in range(days):
+        day = start + timedelta(days=i)
+        fname = os.path.join(path, day.strftime('%Y%m%d') + '_spectroman.csv')
+        if not os.path.exists(fname):
+            write_csv(fname, day, rows, seed=i, junk=junk)
+        files.append(fname)
+    return files
@@ -0,0 +1,337 @@
+"""
+Spectroman benchmarks: time the hot paths (csv parsing, processing,
+interpolation, RRS, products, database bulk writes and reads, plot
+renderers) over synthetic station data (see benchmarks.gen) at day,
+month and year scale, and write the results as JSON so the runs can be
+compared.
+
+Run from the repository root (the settings are read as usual):
+
+    python -m benchmarks.run --scale day month --output bench.json
+    python -m benchmarks.run --db mock --compare bench.json
+    python -m benchmarks.run --scale day --no-db --pages 0 --float32
+
+The database benchmarks use DB_URI (a '<DB_NAME>_bench' database that
+is dropped at the end) or an in-process stand-in with --db mock (needs
+mongomock).
+"""
+import json
+import time
+import argparse
+import platform
+import tempfile
+from os.path import getsize, join
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from spectroman.conf import conf, __version__
+from spectroman.const import *
+from spectroman.data import csv_to_df, process_df, convert_strs
+from spectroman.db import Db
+from spectroman.core import Spectroman
+from spectroman.plot import Plot, PlotCache
+
+from benchmarks.gen import write_days
+
+scales = {'day': 1, 'month': 30, 'year': 365}
+
+class Bench:
+    """
+    Accumulate the timings (seconds, calls, rows and bytes) of each
+    benchmark name of a scale.
+    """
+    def __init__(self):
+        self.results = {}
+
+    @contextmanager
+    def timed(self, name, rows=0, nbytes=0):
+        """
+        Time the block, the rows and bytes can also be added to the
+        yielded result.
+        """
+        r = self.results.setdefault(name, {'seconds': 0.0,
+                                           'calls': 0,
+                                           'rows': 0,
+                                           'bytes': 0})
+        beg = time.perf_counter()
+        try:
+            yield r
+        finally:
+            r['seconds'] += time.perf_counter() - beg
+            r['calls'] += 1
+            r['rows'] += rows
+            r['bytes'] += nbytes
+
+    def summary(self):
+        """
+        Return the results with the rows/s and MB/s rates.
+        """
+        for r in self.results.values():
+            if r['seconds'] > 0:
+                r['rows_s'] = r['rows'] / r['seconds']
+                r['mb_s'] = r['bytes'] / r['seconds'] / 2**20
+        return self.results
+
+def bench_scale(files, db=None, pages=10):
+    """
+    Run the benchmarks over the files (one per day), the database
+    benchmarks only if db (Db) is set and up to pages of each plot
+    renderer are rendered.
+    """
+    b = Bench()
+    s = Spectroman()
+    plot = Plot(workers=1)
+    # every page is rendered
+    plot.cache = PlotCache(None)
+    rendered = {'render_base': 0, 'daily_graph': 0}
+    css = []
+
+    if db is not None:
+        s.db = db
+        s.db.ensure_indexes()
+
+    for f in files:
+        with b.timed('data.csv_to_df', nbytes=getsize(f)) as r:
+            raw = csv_to_df(f)
+        n = len(raw)
+        r['rows'] += n
+
+        with b.timed('data.process_df', rows=n):
+            df = convert_strs(process_df(raw.copy()), calib_columns)
+
+        blocks = []
+        with b.timed('core.interpolate', rows=n):
+            for input_cols, output_cols, intp_op in s.intp_op_table:
+                blocks.append(s.interpolate(df, input_cols, output_cols,
+                                            intp_op))
+        intp = pd.concat(blocks, axis=1, copy=False)
+        rss = []
+        with b.timed('core.calc_rss', rows=n):
+            for input_cols, output_cols in rss_param_table:
+                rss.append(s.calc_rss(intp, input_cols, output_cols))
+        rss = {'rss1': rss[0].to_numpy(), 'rss2': rss[1].to_numpy()}
+        with b.timed('core.calc_products', rows=n):
+            s.calc_products_arr(rss)
+
+        with b.timed('core.process_df', rows=n):
+            spectra = s.process_df(raw.copy())
+
+        with b.timed('core.ingest_df', rows=n):
+            docs = s.ingest_df(raw.copy())
+        css += [{'TIMESTAMP': d['TIMESTAMP'], 'css1': d['css1'],
+                 'css2': d['css2']} for d in docs]
+
+        if db is not None:
+            with b.timed('db.bulk_insert', rows=n):
+                with db.bulk_writer(conf['DB_COLL_RAW']) as writer:
+                    for doc in raw.to_dict('records'):
+                        writer.insert(doc)
+            with b.timed('db.bulk_upsert', rows=len(docs)):
+                with db.bulk_writer(conf['DB_COLL_DF']) as writer:
+                    for doc in docs:
+                        writer.update({'TIMESTAMP': doc['TIMESTAMP']},
+                                      {'$set': doc},
+                                      upsert=True)
+
+        if pages:
+            with b.timed('plot.windows', rows=len(spectra)):
+                windows = list(plot.windows(spectra))
+            for ts, blocks in windows:
+                if rendered['render_base'] >= pages:
+                    break
+                rendered['render_base'] += 1
+                dts = pd.Timestamp(ts).strftime("%Y-%m-%d-%H-%M-%S")
+                with b.timed('plot.render_base', rows=len(blocks['ed'])):
+                    plot.render_base(dts, blocks, conf['PLOT_OUTPUT'] + dts)
+            if rendered['daily_graph'] < pages:
+                rendered['daily_graph'] += 1
+                with b.timed('plot.daily_graph', rows=len(docs)):
+                    plot.daily_graph(docs[0]['TIMESTAMP'], docs)
+
+    if db is not None:
+        start = css[0]['TIMESTAMP']
+        end = css[-1]['TIMESTAMP']
+        with b.timed('db.fetch_spectra', rows=len(css)):
+            db.fetch_spectra({'TIMESTAMP': {'$gte': start, '$lte': end}},
+                             ['rss1', 'rss2'],
+                             conf['DB_COLL_DF'])
+
+    if pages:
+        months = {}
+        for d in css:
+            months.setdefault(d['TIMESTAMP'].strftime('%Y-%m'), []).append(d)
+        for docs in list(months.values())[:pages]:
+            beg = docs[0]['TIMESTAMP']
+            with b.timed('plot.monthly_css', rows=len(docs)):
+                plot.monthly_css(beg, docs[-1]['TIMESTAMP'],
+                                 [d['TIMESTAMP'] for d in docs], docs)
+    return b.summary()
+
+def bench_float32(files):
+    """
+    Compare the float32 mode (see 'FLOAT32') with float64 over the
+    files: the spectra and products errors (max absolute error and
+    max/median error relative to the float64 values scale), the data
+    frames memory, the encoded spectra document sizes and the compute
+    time of each mode.
+    """
+    import bson
+    modes = {}
+    for dtype in ['float64', 'float32']:
+        s = Spectroman(dtype=dtype)
+        s.db = Db(dtype=dtype)
+        modes[dtype] = {'s': s, 'spectra': {}, 'seconds': 0.0,
+                        'memory': 0, 'fields': 0, 'packed': 0}
+
+    for f in files:
+        df = convert_strs(process_df(csv_to_df(f)), calib_columns)
+        calib = df[calib_columns].to_numpy(dtype='float64')
+        for dtype, m in modes.items():
+            s = m['s']
+            beg = time.perf_counter()
+            spectra = s.calc_spectra_arr(calib)
+            spectra.update(s.calc_products_arr(spectra))
+            m['seconds'] += time.perf_counter() - beg
+            for name, arr in spectra.items():
+                m['spectra'].setdefault(name, []).append(arr)
+            m['memory'] += int(s.calc_spectra(df)
+                               .memory_usage(deep=True).sum())
+            # one document spectra per file, encoded on both schemas
+            doc = {name: arr[0] for name, arr in spectra.items()
+                   if name in intp_names}
+            for schema in ['fields', 'packed']:
+                s.db.schema = schema
+                m[schema] += len(bson.encode(s.db.spectra_values(doc,
+                                                                 nested=True)))
+
+    report = {'errors': {}}
+    for name in modes['float64']['spectra']:
+        a = np.concatenate(modes['float64']['spectra'][name])
+        b = np.concatenate(modes['float32']['spectra'][name]).astype('float64')
+        ok = np.isfinite(a) & np.isfinite(b)
+        err = np.abs(a[ok] - b[ok])
+        scale = np.max(np.abs(a[ok])) if ok.any() else 0.0
+        report['errors'][name] = {
+            'max_abs': float(err.max()) if ok.any() else 0.0,
+            'max_rel': float(err.max() / scale) if scale else 0.0,
+            'median_rel': float(np.median(err) / scale) if scale else 0.0,
+            # values finite on one mode only (e.g. exp overflow)
+            'mismatch': int((np.isfinite(a) != np.isfinite(b)).sum())}
+    for dtype, m in modes.items():
+        report[dtype] = {k: m[k] for k in ['seconds', 'memory', 'fields',
+                                           'packed']}
+    return report
+
+def print_float32(report):
+    """
+    Print the float32 accuracy report.
+    """
+    print(f"{'spectrum':10} {'max abs':>12} {'max rel':>12} "
+          f"{'median rel':>12} {'mismatch':>9}")
+    for name, e in report['errors'].items():
+        print(f"{name:10} {e['max_abs']:12.3e} {e['max_rel']:12.3e} "
+              f"{e['median_rel']:12.3e} {e['mismatch']:9d}")
+    for dtype in ['float64', 'float32']:
+        r = report[dtype]
+        print(f"{dtype}: {r['seconds']:.3f} s, frames {r['memory'] / 2**20:.1f}"
+              f" MB, document spectra {r['fields']} B (fields) "
+              f"{r['packed']} B (packed)")
+
+def bench_db(uri):
+    """
+    Return the benchmarks Db, an in-process stand-in if uri is 'mock'.
+    """
+    if uri == 'mock':
+        import pymongo
+        import mongomock
+        pymongo.MongoClient = mongomock.MongoClient
+    return Db(uri=None if uri == 'mock' else uri,
+              name=conf['DB_NAME'] + '_bench')
+
+def compare(old, new):
+    """
+    Print the seconds of the old and new results and their ratio.
+    """
+    print(f"{'scale':6} {'benchmark':20} {'old (s)':>10} {'new (s)':>10} "
+          f"{'ratio':>7}")
+    for scale, results in new['scales'].items():
+        for name, r in results.items():
+            o = old.get('scales', {}).get(scale, {}).get(name)
+            if o is None:
+                continue
+            ratio = r['seconds'] / o['seconds'] if o['seconds'] else 0
+            print(f"{scale:6} {name:20} {o['seconds']:10.3f} "
+                  f"{r['seconds']:10.3f} {ratio:7.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.run',
+        description='Spectroman benchmarks.')
+    parser.add_argument('--scale', nargs='+', default=['day', 'month'],
+                        choices=list(scales),
+                        help='Data scales (default: day month).')
+    parser.add_argument('--rows', type=int, default=1440,
+                        help='Rows per day (default: 1440, one per minute).')
+    parser.add_argument('--data',
+                        help='Synthetic csv files folder (kept between runs).')
+    parser.add_argument('--db', nargs='?', const='mock',
+                        help='Database URI (default, DB_URI) or mock.')
+    parser.add_argument('--no-db', action='store_true',
+                        help='Skip the database benchmarks.')
+    parser.add_argument('--pages', type=int, default=10,
+                        help='Pages rendered per plot renderer (0 skips).')
+    parser.add_argument('--output', default='bench.json',
+                        help='Results JSON file (default: bench.json).')
+    parser.add_argument('--compare',
+                        help='Previous results JSON file to compare with.')
+    parser.add_argument('--float32', action='store_true',
+                        help='Report the float32 mode accuracy against '
+                        'float64.')
+    args = parser.parse_args()
+
+    data = args.data or join(tempfile.gettempdir(), 'spectroman_bench')
+    conf['PLOT_OUTPUT'] = tempfile.mkdtemp(prefix='spectroman_plots_') + '/'
+    start = datetime(2023, 1, 1)
+
+    out = {'meta': {'version': __version__,
+                    'date': datetime.now().isoformat(timespec='seconds'),
+                    'python': platform.python_version(),
+                    'numpy': np.__version__,
+                    'pandas': pd.__version__,
+                    'machine': platform.machine(),
+                    'rows': args.rows,
+                    'db': None if args.no_db else args.db or 'uri'},
+           'scales': {}}
+
+    for scale in args.scale:
+        files = write_days(join(data, str(args.rows)), start,
+                           scales[scale], args.rows)
+        db = None
+        if not args.no_db:
+            db = bench_db(args.db or conf['DB_URI'])
+        try:
+            out['scales'][scale] = bench_scale(files, db, args.pages)
+        finally:
+            if db is not None:
+                db.connect()
+                db.client.drop_database(db.name)
+                db.close()
+        for name, r in out['scales'][scale].items():
+            print(f"{scale:6} {name:20} {r['seconds']:10.3f} s "
+                  f"{r.get('rows_s', 0):12.0f} rows/s")
+        if args.float32:
+            out.setdefault('float32', {})[scale] = bench_float32(files)
+            print_float32(out['float32'][scale])
+
+    with open(args.output, 'w') as f:
+        json.dump(out, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), out)
+
+if __name__ == '__main__':
+    main()
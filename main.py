@@ -4,62 +4,136 @@ import spectroman
 
 from spectroman.log import log
 from spectroman.ftp import Ftp
-from spectroman.conf import conf
+from spectroman.conf import conf, __version__
+from spectroman.metrics import metrics
 from spectroman.util import  *
-from spectroman.core import Spectroman
 
-def process_csvs():
+def get_spectroman():
+    """
+    Return a Spectroman instance, the processing modules are only
+    imported by the commands that need them.
+    """
+    from spectroman.core import Spectroman
+    return Spectroman()
+
+def date_range(parser, args, required=True):
+    """
+    Return the plot commands dates range, exit with the usage message if
+    the range is not valid.
+    """
+    try:
+        return get_range(args['start'], args['end'], required)
+    except ValueError as e:
+        parser.error(str(e))
+
+def process_csvs(workers=1):
     """
     Process the previous fetched csvs.
     """
-    s = Spectroman()
-    s.process_files(list_csvs())
+    s = get_spectroman()
+    s.process_files(list_csvs(), workers)
     pass
 
-def plot_basic(dates):
+def plot_basic(start, end):
     """
-    Plot basic graph from dates list.
+    Plot basic graph of the days between start and end.
     """
-    s = Spectroman()
-    for date in dates:
-        s.plot_basic_graph(date)
-        pass
+    s = get_spectroman()
+    s.plot_basic_range(start, end)
+    # wait for the pages still rendering
+    s.plot.join()
+    pass
+
+def plot_daily(start, end):
+    """
+    Plot daily graph of the days between start and end.
+    """
+    s = get_spectroman()
+    s.plot_daily_range(start, end)
+    s.plot.join()
     pass
 
-def plot_daily(dates):
+def plot_monthly(start=None, end=None):
     """
-    Plot daily graph from dates list.
+    Plot the SSS monthly graph of the months between start and end
+    (default, the data extent).
     """
-    s = Spectroman()
-    for date in dates:
-        s.plot_daily_graph(date)
+    s = get_spectroman()
+    s.plot_monthly_graph(start, end)
+    s.plot.join()
     pass
 
 def insert_data():
     """
     Insert data to the database.
     """
-    s = Spectroman()
+    s = get_spectroman()
+    s.db.ensure_indexes()
     s.insert_docs(conf['DATA_OUTPUT'])
 
+def ingest_data(raw=False):
+    """
+    Insert and process data in a single pass (fused pipeline).
+    """
+    s = get_spectroman()
+    s.db.ensure_indexes()
+    s.ingest(conf['DATA_OUTPUT'], raw)
+
 def clean_data():
     """
     Remove inconsistent data and convert strings to float.
     """
-    s = Spectroman()
+    s = get_spectroman()
+    s.db.ensure_indexes()
     s.clean_docs()
     s.convert_docs()
     pass
 
-def process_data():
+def process_data(full=False):
     """
-    Process database data.
+    Process database data, all the documents are processed again
+    if full is set.
     """
-    s = Spectroman()
-    s.process_intp()
-    s.process_css()
+    s = get_spectroman()
+    s.db.ensure_indexes()
+    s.process_intp(full=full)
+    s.process_css(full=full)
     pass
 
+def index_data():
+    """
+    Create the database indexes and tag the stored documents
+    processing stage.
+    """
+    s = get_spectroman()
+    failed = s.db.ensure_indexes()
+    s.init_stages()
+    if len(failed) > 0:
+        raise SystemExit(f'{len(failed)} indexes not created, see the log.')
+
+def migrate_data():
+    """
+    Migrate the database documents to the packed spectra schema.
+    """
+    s = get_spectroman()
+    s.migrate_docs()
+    log.info('Migration done, set DB_SCHEMA=packed in settings.ini.')
+
+def fetch_ingest_data(raw=False):
+    """
+    Fetch the csv files and ingest them while they are downloaded.
+    """
+    s = get_spectroman()
+    s.db.ensure_indexes()
+    s.fetch_ingest(raw)
+
+def watch_data(interval=None, folder=None):
+    """
+    Watch the FTP host (or a local folder) and ingest the new files.
+    """
+    from spectroman.watch import watch
+    watch(interval, folder)
+
 def fetch_csvs():
     """
     Fetch csvs file from the FTP host, they will be
@@ -78,6 +152,11 @@ if __name__ == "__main__":
                         help='Process csv files',
                         action='store_true')
 
+    parser.add_argument('-w', '--workers',
+                        help='Number of worker processes (default, 1).',
+                        type=int,
+                        default=1)
+
     parser.add_argument('-p', '--process',
                         help='Process data',
                         action='store_true')
@@ -86,18 +165,50 @@ if __name__ == "__main__":
                         help='Clean inconsistent data from the database.',
                         action='store_true')
 
+    parser.add_argument('--full',
+                        help='Process all the documents again (with --process).',
+                        action='store_true')
+
     parser.add_argument('--clean',
                         help='Clean data to the database (mongodb).',
                         action='store_true')
 
+    parser.add_argument('--index',
+                        help='Create the database indexes and tag the documents stage.',
+                        action='store_true')
+
+    parser.add_argument('--migrate',
+                        help='Migrate the database to the packed spectra schema.',
+                        action='store_true')
+
     parser.add_argument('-a', '--all',
                         help='Insert and process data.',
                         action='store_true')
 
+    parser.add_argument('--raw',
+                        help='Also store the raw documents (with --all or --stream).',
+                        action='store_true')
+
     parser.add_argument('-f', '--fetch',
                         help='Download csv files from FTP',
                         action='store_true')
 
+    parser.add_argument('--stream',
+                        help='Fetch and ingest the csv files at the same time.',
+                        action='store_true')
+
+    parser.add_argument('--watch',
+                        help='Watch the FTP host (or --folder) and ingest the new files.',
+                        action='store_true')
+
+    parser.add_argument('--folder',
+                        help='Local drop folder watched instead of the FTP host.',
+                        nargs='?')
+
+    parser.add_argument('--interval',
+                        help='Watch interval in seconds (default, WATCH_INTERVAL).',
+                        type=float)
+
     parser.add_argument('-b', '--basic',
                         help='Plot basic graph.',
                         action='store_true')
@@ -118,6 +229,10 @@ if __name__ == "__main__":
                         help='End date in the format: year-month-day.',
                         nargs='?')
 
+    parser.add_argument('--metrics',
+                        help='Collect the stages metrics (default, METRICS) and export them to METRICS_OUTPUT.',
+                        action='store_true')
+
     parser.add_argument('-v', '--version',
                         help='Displays current package version.',
                         action='store_true')
@@ -125,25 +240,39 @@ if __name__ == "__main__":
     # Converts the input arguments from Namespace() to dict
     args = parser.parse_args().__dict__
 
+    if args['metrics']:
+        metrics.enabled = True
+
     if args['version']:
         log.info(f'SPECTROMAN version: {__version__}')
     elif args['csv']:
-        process_csvs()
+        process_csvs(args['workers'])
     elif args['insert']:
         insert_data()
     elif args['process']:
-        process_data()
+        process_data(args['full'])
     elif args['clean']:
         clean_data()
+    elif args['index']:
+        index_data()
+    elif args['migrate']:
+        migrate_data()
     elif args['all']:
-        insert_data()
-        clean_data()
-        process_data()
+        ingest_data(args['raw'])
     elif args['basic']:
-        plot_basic(get_dates(args['start'], args['end']))
+        plot_basic(*date_range(parser, args))
     elif args['day']:
-        plot_daily(get_dates(args['start'], args['end']))
+        plot_daily(*date_range(parser, args))
+    elif args['month']:
+        plot_monthly(*date_range(parser, args, required=False))
+    elif args['stream']:
+        fetch_ingest_data(args['raw'])
+    elif args['watch']:
+        watch_data(args['interval'], args['folder'])
     elif args['fetch']:
         fetch_csvs()
     else:
         pass
+
+    # export the run metrics (if enabled)
+    metrics.export()
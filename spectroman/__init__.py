@@ -1 +1 @@
-__version__ = '1.0.0'
\ No newline at end of file
+__version__ = '2.0.0'
\ No newline at end of file
@@ -1,4 +1,4 @@
-from decouple import config
+from decouple import config, Csv
 
 __version__ = '2.0.0'
 
@@ -7,6 +7,9 @@ conf = {
     'FTP_USER': config('FTP_USER'),
     'FTP_PASS': config('FTP_PASS'),
     'FTP_PATH': config('FTP_PATH'),
+    'FTP_PORT': config('FTP_PORT', default=21, cast=int),
+    'FTP_WORKERS': config('FTP_WORKERS', default=4, cast=int),
+    'FTP_MANIFEST': config('FTP_MANIFEST', default='ftp_manifest.json'),
     'FTP_TODO': config('FTP_TODO'),
     'FTP_DONE': config('FTP_DONE'),
     'FTP_FAIL': config('FTP_FAIL'),
@@ -15,10 +18,32 @@ conf = {
     'DB_COLL_DF': config('DB_COLL_DF'),
     'DB_COLL_RAW': config('DB_COLL_RAW'),
     'DB_COLL_MAIN': config('DB_COLL_MAIN'),
+    'DB_COLL_LEDGER': config('DB_COLL_LEDGER', default='ledger'),
+    'DB_POOL_SIZE': config('DB_POOL_SIZE', default=10, cast=int),
+    'DB_TIMEOUT_MS': config('DB_TIMEOUT_MS', default=30000, cast=int),
+    'DB_WRITE_CONCERN': config('DB_WRITE_CONCERN', default='1'),
+    'DB_BATCH_SIZE': config('DB_BATCH_SIZE', default=1000, cast=int),
+    'DB_BATCH_INTERVAL': config('DB_BATCH_INTERVAL', default=5.0, cast=float),
+    'PROC_CHUNK_SIZE': config('PROC_CHUNK_SIZE', default=1000, cast=int),
+    'CSV_CHUNK_SIZE': config('CSV_CHUNK_SIZE', default=1000, cast=int),
+    'CSV_MEMORY_MAP': config('CSV_MEMORY_MAP', default=False, cast=bool),
+    'DB_SCHEMA': config('DB_SCHEMA', default='fields'),
+    'PIPE_QUEUE_SIZE': config('PIPE_QUEUE_SIZE', default=16, cast=int),
+    'WATCH_INTERVAL': config('WATCH_INTERVAL', default=60.0, cast=float),
+    'WATCH_HEARTBEAT': config('WATCH_HEARTBEAT', default='heartbeat.json'),
+    'FLOAT32': config('FLOAT32', default=False, cast=bool),
+    'PRODUCTS': config('PRODUCTS', default='css,chla,spm,cdom', cast=Csv()),
+    'METRICS': config('METRICS', default=False, cast=bool),
+    'METRICS_OUTPUT': config('METRICS_OUTPUT', default='metrics.json'),
     'DB_ATLAS_URI': config('DB_ATLAS_URI'),
     'DB_ATLAS_NAME': config('DB_ATLAS_NAME'),
     'DB_ATLAS_COLL': config('DB_ATLAS_COLL'),
     'PLOT_OUTPUT': config('PLOT_OUTPUT'),
+    'PLOT_STAT': config('PLOT_STAT', default=''),
+    'PLOT_DPI': config('PLOT_DPI', default=200, cast=int),
+    'PLOT_FORMAT': config('PLOT_FORMAT', default='png'),
+    'PLOT_WORKERS': config('PLOT_WORKERS', default=1, cast=int),
+    'PLOT_CACHE': config('PLOT_CACHE', default='plot_cache.json'),
     'LOG_OUTPUT': config('LOG_OUTPUT'),
     'DATA_OUTPUT': config('DATA_OUTPUT'),
     'DATA_BACKUP': config('DATA_BACKUP')
@@ -2,7 +2,8 @@
 import numpy as np
 
 # internal modules
-from spectroman.data import get_wl_dat, wl_dat_5
+from spectroman.conf import conf
+from spectroman.model import linear_intp_op
 
 def gen_columns(param, beg, end):
     """
@@ -16,6 +17,16 @@ def gen_calib_cols(param):
     """
     return ['CalibData_' + param + '(' + str(i) + ')' for i in range(1, 167)]
 
+# daily plots window hours, both included (see util.in_hours)
+day_hours = [6, 18]
+
+# documents processing stages (STAGE field)
+STAGE_RAW = 'raw'
+STAGE_CLEANED = 'cleaned'
+STAGE_SKIPPED = 'skipped'
+STAGE_INTP = 'interpolated'
+STAGE_CSS = 'css'
+
 # parameters columns
 ed_cols   = gen_columns('ed_',   410, 941)
 ld1_cols  = gen_columns('ld1_',  410, 941)
@@ -46,20 +57,43 @@ calib_columns =\
     c4_cols + \
     c5_cols
 
-# interpolation set values and parameters table
+# derived spectra float type, float32 halves their memory (see 'FLOAT32'),
+# the raw CalibData values are always parsed as float64
+float_dtype = 'float32' if conf['FLOAT32'] else 'float64'
+
+# csv columns data types
+csv_dtypes = {'TIMESTAMP': 'str',
+              'RECORD': 'float64',
+              'Batt': 'float64',
+              'Temp_Box': 'float64',
+              'Tens_Pira': 'float64'}
+csv_dtypes.update({c: 'float64' for c in calib_columns})
+
+# interpolation set values
 intp_arr = np.arange(410,941)
 intp_set = np.array(intp_arr, dtype='str')
-intp_table = \
-    [[c1_cols, ed_cols, get_wl_dat('wl8711_01600011.dat')],
-     [c2_cols, ld1_cols, get_wl_dat('wl8712_0160022.dat')],
-     [c3_cols, ld2_cols, get_wl_dat('wl8713_06900023.dat')],
-     [c4_cols, lu1_cols, get_wl_dat('wl8714_06900024.dat')],
-     [c5_cols, lu2_cols, wl_dat_5()]]
 
 # rss parameters table (or rss input/output columns)
 rss_param_table =\
-    [[ed_cols + ld1_cols + lu1_cols, rss1_cols],
-     [ed_cols + ld2_cols + lu2_cols, rss2_cols]]
+    [[[ed_cols, ld1_cols, lu1_cols], rss1_cols],
+     [[ed_cols, ld2_cols, lu2_cols], rss2_cols]]
+
+# spectra (packed storage schema) names and columns
+calib_names = ['c1', 'c2', 'c3', 'c4', 'c5']
+intp_names = ['ed', 'ld1', 'ld2', 'lu1', 'lu2', 'rss1', 'rss2']
+spectra_table = {'c1': c1_cols,
+                 'c2': c2_cols,
+                 'c3': c3_cols,
+                 'c4': c4_cols,
+                 'c5': c5_cols,
+                 'ed': ed_cols,
+                 'ld1': ld1_cols,
+                 'ld2': ld2_cols,
+                 'lu1': lu1_cols,
+                 'lu2': lu2_cols,
+                 'rss1': rss1_cols,
+                 'rss2': rss2_cols}
+spectra_names = {c: name for name, cols in spectra_table.items() for c in cols}
 
 base_graph_table = [['ed',   'ED - ',   ed_cols],
                     ['ld1',  'LD1 - ',  ld1_cols],
@@ -157,3 +191,48 @@ day_plot_conf = {
 
 monthly_graph_dict = {'keys': ['css1', 'css2'],
                       'ylim': [0, 500]}
+
+def get_intp_table():
+    """
+    Return the interpolation parameters table (input columns, output
+    columns and wavelengths).
+    """
+    from spectroman.data import get_wl_dat, wl_dat_5
+    return [[c1_cols, ed_cols, get_wl_dat('wl8711_01600011.dat')],
+            [c2_cols, ld1_cols, get_wl_dat('wl8712_0160022.dat')],
+            [c3_cols, ld2_cols, get_wl_dat('wl8713_06900023.dat')],
+            [c4_cols, lu1_cols, get_wl_dat('wl8714_06900024.dat')],
+            [c5_cols, lu2_cols, wl_dat_5()]]
+
+def get_intp_op_table():
+    """
+    Return the interpolation operators table, computed once per
+    wavelength table in the spectra float type (float_dtype).
+    """
+    from spectroman import const
+    return [[input_cols, output_cols,
+             linear_intp_op(wl_data, intp_arr).astype(float_dtype)]
+            for input_cols, output_cols, wl_data in const.intp_table]
+
+def get_spectra_axis():
+    """
+    Return the spectra wavelengths axis.
+    """
+    from spectroman import const
+    axis = {name: intp_arr for name in intp_names}
+    axis.update({name: wl_data for name, (_, _, wl_data) in
+                 zip(calib_names, const.intp_table)})
+    return axis
+
+# tables built on first access (see __getattr__), they need the wl_dat
+# files and scipy, use them as const.<name> (star imports skip them)
+lazy_tables = {'intp_table': get_intp_table,
+               'intp_op_table': get_intp_op_table,
+               'spectra_axis': get_spectra_axis}
+
+def __getattr__(name):
+    # only called for the names not set yet
+    if name in lazy_tables:
+        value = globals()[name] = lazy_tables[name]()
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
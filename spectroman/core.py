@@ -1,61 +1,151 @@
-from os.path import basename
+import queue
+import threading
+from os.path import basename, getsize
 from datetime import datetime, time, timedelta
+from concurrent.futures import ProcessPoolExecutor
 
 from spectroman.util import *
 from spectroman.data import *
+from spectroman import const
 from spectroman.const import *
 from spectroman.model import *
 
-from spectroman.db import Db
+from spectroman.db import Db, Ledger, SPECTRA, AXIS, pack_arr
 from spectroman.ftp import Ftp
 from spectroman.log import log
-from spectroman.plot import Plot
+from spectroman.metrics import metrics
 
 class Spectroman:
-    def __init__(self):
+    def __init__(self, dtype=None):
         self.db = Db()
         self.ftp = Ftp()
-        self.plot = Plot()
+        self.renderer = None
+        # derived spectra float type (see 'FLOAT32'), the raw CalibData
+        # values are always kept in float64
+        self.dtype = dtype or float_dtype
+        self.ops = None
+        # product bands resolved once against the spectra wavelengths
+        self.bands = product_bands(conf['PRODUCTS'], intp_arr)
         pass
 
-    def interpolate(self, df, input_cols, output_cols, intp_data):
+    @property
+    def plot(self):
         """
-        Calculate the linear interpolation.
+        The plots renderer (Plot), created on first use.
         """
+        if self.renderer is None:
+            from spectroman.plot import Plot
+            self.renderer = Plot()
+        return self.renderer
+
+    @property
+    def intp_op_table(self):
+        """
+        The interpolation operators table in the spectra float type,
+        the const table is cast only once for another float type.
+        """
+        if self.ops is None:
+            self.ops = [[input_cols, output_cols,
+                         intp_op.astype(self.dtype, copy=False)]
+                        for input_cols, output_cols, intp_op
+                        in const.intp_op_table]
+        return self.ops
+
+    def interpolate(self, df, input_cols, output_cols, intp_op):
+        """
+        Calculate the linear interpolation of the whole input block
+        using the precomputed interpolation operator (intp_op_table)
+        and return it as a column block indexed like df.
+        """
+        df_out = pd.DataFrame(index=df.index)
         # calculate the interpolation for param: [c1, c2, c3, c4, c4]
         try:
-            df_out = df[input_cols].apply(linear_intp,
-                                          args=(intp_data, intp_set),
-                                          # raw=True,
-                                          result_type='expand',
-                                          axis=1)
-            df_out.columns = output_cols
+            with metrics.timer('interpolate', rows=len(df)):
+                df_out = pd.DataFrame(linear_intp_arr(df[input_cols],
+                                                      intp_op),
+                                      index=df.index,
+                                      columns=output_cols)
         except Exception as e:
             log.info(e)
             pass
-        else:
-            df = df.join(df_out, how='left')
         finally:
-            return df
+            return df_out
 
-    def calc_rss(self, df, input_cols, output_cols):
+    def calc_rss(self, df, input_cols, output_cols, rho=0.028):
         """
-        Given a data frame, compute the RRS values and
-        return it.
+        Given a data frame and the [ed, ld, lu] input columns, compute
+        the RRS values of all rows at once and return them as a column
+        block indexed like df. The rho value can be a scalar, a per-row
+        (n_rows, 1) or a per-wavelength (n_wl,) array.
         """
+        df_out = pd.DataFrame(index=df.index)
         try:
-            df_out = df[input_cols].apply(calc_rrs_reflectance,
-                                          # raw=True,
-                                          result_type='expand',
-                                          axis=1)
-            df_out.columns = output_cols
+            with metrics.timer('rrs', rows=len(df)):
+                ed, ld, lu = [df[cols].to_numpy(dtype=self.dtype)
+                              for cols in input_cols]
+                df_out = pd.DataFrame(calc_rrs_arr(ed, ld, lu, rho,
+                                                   self.dtype),
+                                      index=df.index,
+                                      columns=output_cols)
         except Exception as e:
             log.info(e)
             pass
-        else:
-            df = df.join(df_out, how='left')
         finally:
-            return df
+            return df_out
+
+    def calc_spectra(self, df, rho=0.028):
+        """
+        Compute the interpolation and RRS values of the data frame
+        and return it joined with the new columns.
+        """
+        blocks = [self.interpolate(df, input_cols, output_cols, intp_op)
+                  for input_cols, output_cols, intp_op in self.intp_op_table]
+        # compute the rss values from the interpolated parameters
+        intp = pd.concat(blocks, axis=1, copy=False)
+        blocks += [self.calc_rss(intp, input_cols, output_cols, rho)
+                   for input_cols, output_cols in rss_param_table]
+        return pd.concat([df] + blocks, axis=1, copy=False)
+
+    def calc_spectra_arr(self, calib, rho=0.028):
+        """
+        Given the (n_rows, len(calib_columns)) CalibData block, compute
+        the interpolation and RRS values of all rows at once and return
+        the spectra (name: (n_rows, len(intp_arr)) array) dictionary.
+        """
+        spectra = {}
+        with metrics.timer('interpolate', rows=len(calib)):
+            for input_cols, output_cols, intp_op in self.intp_op_table:
+                i = calib_columns.index(input_cols[0])
+                spectra[spectra_names[output_cols[0]]] =\
+                    linear_intp_arr(calib[:, i:i + len(input_cols)], intp_op)
+        # compute the rss values from the interpolated parameters
+        with metrics.timer('rrs', rows=len(calib)):
+            for (ed, ld, lu), output_cols in rss_param_table:
+                spectra[spectra_names[output_cols[0]]] =\
+                    calc_rrs_arr(spectra[spectra_names[ed[0]]],
+                                 spectra[spectra_names[ld[0]]],
+                                 spectra[spectra_names[lu[0]]],
+                                 rho,
+                                 self.dtype)
+        return spectra
+
+    def products_stage(self):
+        """
+        Return the stage of the documents once the selected products
+        (see 'PRODUCTS') are computed, the css stage needs the css
+        product.
+        """
+        return STAGE_CSS if 'css' in self.bands else STAGE_INTP
+
+    def calc_products_arr(self, spectra):
+        """
+        Given the rss spectra (name: (n_rows, len(intp_arr)) array),
+        compute the selected products (see 'PRODUCTS') of both
+        radiometers pairs and all rows at once.
+        """
+        with metrics.timer('products', rows=len(spectra['rss1'])):
+            return calc_products([spectra['rss1'], spectra['rss2']],
+                                 self.bands)
 
     def read_csv(self, csv):
         """
@@ -63,262 +153,666 @@ class Spectroman:
         """
         df = pd.DataFrame()
         try:
-            df = csv_to_df(csv)
+            with metrics.timer('csv_parse',
+                               nbytes=getsize(csv) if isinstance(csv, str)
+                               else 0) as t:
+                df = csv_to_df(csv)
+                t.rows = len(df)
         except Exception as e:
             pass
         finally:
             return df
 
+    def iter_csv(self, fname, chunksize=None, entry=None):
+        """
+        Parse the csv file lazily, yielding its data frame chunks of
+        chunksize (default, 'CSV_CHUNK_SIZE') rows. A parsing error is
+        recorded on the ledger entry of the file, if given.
+        """
+        try:
+            dfs = iter_csv(fname,
+                           csv_dtypes,
+                           chunksize or conf['CSV_CHUNK_SIZE'],
+                           conf['CSV_MEMORY_MAP'])
+            nbytes = getsize(fname)
+            while True:
+                # time the parsing only, not the chunk consumer
+                with metrics.timer('csv_parse', nbytes=nbytes) as t:
+                    df = next(dfs, None)
+                    t.rows = 0 if df is None else len(df)
+                if df is None:
+                    break
+                nbytes = 0
+                yield df
+        except Exception as e:
+            log.info(f"Exception {fname}: {e}")
+            if entry is not None:
+                entry['error'] = repr(e)
+        finally:
+            pass
+
     def process_df(self, df):
         """
         Given a csv files, compute the interpolation and RRS values.
         """
-        df = process_df(df)
-        bk = df
-        if (not df.empty) and len(df) > 1:
-            # compute the interpolation
-            for input_cols, output_cols, intp_data in intp_table:
-                df = self.interpolate(df,
-                                      input_cols,
-                                      output_cols,
-                                      intp_data)
-
-            # compute the rss values from the interpolated parameters
-            for input_cols, output_cols in rss_param_table:
-                df = self.calc_rss(df, input_cols, output_cols)
+        with metrics.timer('clean', rows=len(df)):
+            df = process_df(df)
+        if not df.empty:
+            # compute the interpolation and rss values
+            df = self.calc_spectra(df)
         else:
             df = pd.DataFrame()
         return df
 
     def insert_docs(self, path):
         """
-        Process and cache the data-frames into the data base.
+        Process and cache the data-frames into the data base, the files
+        already ingested are skipped (see Ledger) and the rows are
+        upserted by TIMESTAMP.
         """
-        files = list_csvs(path)
-        for f in [file_to_str_io(f) for f in files]:
-            df = self.read_csv(f)
-            if (not df.empty) and len(df) > 1:
-                self.db.insert_docs(df.to_dict('records'), conf['DB_COLL_RAW'])
+        ledger = Ledger(self.db, conf['DB_COLL_RAW'])
+        with self.db.bulk_writer(conf['DB_COLL_RAW'],
+                                 callback=ledger.commit) as writer:
+            for f in list_csvs(path):
+                entry = ledger.check(f)
+                if entry is None:
+                    continue
+                for df in self.iter_csv(f, entry=entry):
+                    df = df[df['TIMESTAMP'].notna()].assign(STAGE=STAGE_RAW)
+                    for doc in df.to_dict('records'):
+                        writer.update({'TIMESTAMP': doc['TIMESTAMP']},
+                                      {'$setOnInsert': doc},
+                                      upsert=True)
+                    entry['rows'] += len(df)
+                ledger.add(entry)
         pass
 
-    def clean_docs(self):
+    def ingest_df(self, df):
         """
-        Clear NaN values from the raw data there is located at
-        conf['DB_COLL_RAW'].
+        Given a parsed csv data frame, clean it and compute the
+        interpolation, RRS and css values in memory, return the final
+        documents.
         """
-        for doc in self.db.fetch_docs(noteq_filter(calib_cols),
-                                      {},
-                                      conf['DB_COLL_RAW']):
-            # convert timestamp string to ISODate
-            try:
-                doc['TIMESTAMP'] =\
-                    datetime.strptime(doc['TIMESTAMP'], "%Y-%m-%d %H:%M:%S")
-            except:
-                pass
-            else:
-                self.db.insert_doc(doc, conf['DB_COLL_DF'])
-            finally:
-                pass
+        with metrics.timer('clean', rows=len(df)):
+            df = convert_strs(process_df(df), calib_columns)
+        if df.empty:
+            return []
+        calib = df[calib_columns].to_numpy(dtype='float64')
+        spectra = self.calc_spectra_arr(calib)
+        products = self.calc_products_arr(spectra)
+        stage = self.products_stage()
+        spectra.update({name: calib[:, i * 166:(i + 1) * 166]
+                        for i, name in enumerate(calib_names)})
+        docs = df.drop(columns=calib_columns).to_dict('records')
+        for i, doc in enumerate(docs):
+            doc.update(self.db.spectra_values({name: arr[i] for name, arr
+                                               in spectra.items()},
+                                              nested=True))
+            doc.update({name: float(arr[i])
+                        for name, arr in products.items()})
+            doc['STAGE'] = stage
+        return docs
 
-    def convert_docs(self):
+    def ingest(self, path=None, raw=False):
         """
-        Convert string types to float types.
+        Fused pipeline: parse the csv files, clean, interpolate and
+        compute the RRS and css values of each row in memory, then write
+        one final document per row (bulk) into the 'DB_COLL_DF'
+        collection. The raw documents are stored on 'DB_COLL_RAW' only
+        if raw is set. The files already ingested are skipped (see
+        Ledger) and the rows are upserted by TIMESTAMP.
+        """
+        self.ingest_files(list_csvs(path), raw)
+
+    def ingest_files(self, files, raw=False):
+        """
+        Fused pipeline over the files iterable, see ingest. Return the
+        number of files ingested, the cached plots of the days ingested
+        are invalidated.
         """
-        for doc in self.db.fetch_docs(fieldstr_filter(calib_columns),
-                                      {},
-                                      conf['DB_COLL_DF']):
-            values = {}
-            for key in calib_columns:
-                if (type(doc[key]) == str):
-                    values[key] = float('.'.join(doc[key].split(".")[:2]))
-                    # update values if necessary
-            if (len(values) > 0):
-                self.db.update_doc({"_id": doc['_id']},
-                                   {"$set": values},
-                                   conf['DB_COLL_DF'])
-    def process_intp(self):
-        """
-        Process the linear interpolation for the database data.
-        """
-        for doc in self.db.fetch_docs(notexists_filter(intp_columns),
-                                      {},
-                                      conf['DB_COLL_DF']):
-            # cache the id
-            id = doc['_id']
-            # remove id from the dictionary
-            doc.pop('_id', None)
-            # parse dict to data frame
-            df = dict_to_df(doc)
-
-            # calculate the interpolation
-            for input_cols, output_cols, wl_data in intp_table:
-                df = self.interpolate(df,
-                                      input_cols,
-                                      output_cols,
-                                      wl_data)
-                # compute the rss values from the interpolated parameters
-            for input_cols, output_cols in rss_param_table:
-                df = self.calc_rss(df, input_cols, output_cols)
-
-            # get values from the data frame
+        ledger = Ledger(self.db, conf['DB_COLL_DF'])
+        raw_writer = self.db.bulk_writer(conf['DB_COLL_RAW'],
+                                         callback=ledger.track)
+        # the ledger entries are stored once the raw and df rows are written
+        writer = self.db.bulk_writer(conf['DB_COLL_DF'],
+                                     callback=lambda ok: (raw_writer.flush(),
+                                                          ledger.commit(ok)))
+        n = 0
+        days = set()
+        with raw_writer, writer:
+            for f in files:
+                entry = ledger.check(f)
+                if entry is None:
+                    continue
+                n += 1
+                for df in self.iter_csv(f, entry=entry):
+                    df = df[df['TIMESTAMP'].notna()]
+                    if raw:
+                        for doc in df.to_dict('records'):
+                            doc['STAGE'] = STAGE_CLEANED
+                            raw_writer.update({'TIMESTAMP': doc['TIMESTAMP']},
+                                              {'$setOnInsert': doc},
+                                              upsert=True)
+                    try:
+                        docs = self.ingest_df(df)
+                    except Exception as e:
+                        log.info(f"Exception {f}: {e}")
+                        entry['error'] = repr(e)
+                        continue
+                    for doc in docs:
+                        writer.update({'TIMESTAMP': doc['TIMESTAMP']},
+                                      {'$set': doc},
+                                      upsert=True)
+                        days.add(doc['TIMESTAMP'].date())
+                    entry['rows'] += len(docs)
+                ledger.add(entry)
+        if days:
+            self.plot.cache.invalidate(days)
+        return n
+
+    def fetch_ingest(self, raw=False, size=None):
+        """
+        Overlapped fetch and ingest: the files are handed to the fused
+        pipeline (see ingest) as soon as they are downloaded, through a
+        bounded queue of size (default, 'PIPE_QUEUE_SIZE') files that
+        holds the downloads back when the processing falls behind.
+        """
+        files = queue.Queue(maxsize=size or conf['PIPE_QUEUE_SIZE'])
+
+        def fetch():
             try:
-                values = df.loc[:,\
-                                ed_cols +
-                                ld1_cols +
-                                ld2_cols +
-                                lu1_cols +
-                                lu2_cols +
-                                rss1_cols +
-                                rss2_cols].to_dict('records')[0]
+                self.ftp.connect()
+                self.ftp.fetch_files()
             except Exception as e:
                 log.info(f"Exception {e}")
-            else:
-                # update the document with the new record values
-                self.db.update_doc({"_id": id},
-                                   {"$set": values},
-                                   conf['DB_COLL_DF'])
             finally:
-                pass
+                files.put(None)
+
+        self.ftp.callback = files.put
+        producer = threading.Thread(target=fetch, daemon=True)
+        producer.start()
+        self.ingest_files(iter(files.get, None), raw)
+        producer.join()
         pass
 
-    def process_css(self):
+    def clean_docs(self):
         """
-        Calculate the css values for the database data.
+        Clear NaN values from the raw data there is located at
+        conf['DB_COLL_RAW'], only the raw stage documents are read. The
+        raw documents are tagged once their outcome is known: cleaned
+        (once their copy is written), skipped (NaN values) or left at
+        the raw stage if they could not be converted or written.
         """
-        for doc in self.db.fetch_docs({}, {}, conf['DB_COLL_DF']):
-            values = {}
+        # raw documents whose copy is buffered on the df writer
+        copied = []
+
+        def tag(ok):
+            # df writer callback: tag the raw documents written
+            ids, copied[:] = list(copied), []
+            for i, _id in enumerate(ids):
+                if i not in writer.failed:
+                    raw_writer.update({"_id": _id},
+                                      {"$set": {'STAGE': STAGE_CLEANED}})
+
+        # the df writer is flushed first, its callback tags the raw ones
+        with self.db.bulk_writer(conf['DB_COLL_RAW']) as raw_writer, \
+             self.db.bulk_writer(conf['DB_COLL_DF'],
+                                 callback=tag) as writer:
+            for doc in self.db.fetch_docs({'STAGE': STAGE_RAW},
+                                          {},
+                                          conf['DB_COLL_RAW']):
+                # skip the documents with NaN values
+                if any(doc.get(c) != doc.get(c) for c in calib_cols):
+                    raw_writer.update({"_id": doc['_id']},
+                                      {"$set": {'STAGE': STAGE_SKIPPED}})
+                    continue
+                # convert timestamp string to ISODate and strings to float
+                metrics.count('docs_cleaned')
+                try:
+                    doc['TIMESTAMP'] =\
+                        datetime.strptime(doc['TIMESTAMP'], "%Y-%m-%d %H:%M:%S")
+                    for key in calib_columns:
+                        if (type(doc.get(key)) == str):
+                            doc[key] = str_to_float(doc[key])
+                    if self.db.packed():
+                        calib = {name: [doc.pop(c) for c in spectra_table[name]]
+                                 for name in calib_names}
+                        doc.update(self.db.spectra_values(calib, nested=True))
+                except Exception as e:
+                    log.info(f"Exception {doc['_id']}: {e}")
+                else:
+                    doc['STAGE'] = STAGE_CLEANED
+                    copied.append(doc['_id'])
+                    writer.insert(doc)
+                finally:
+                    pass
+
+    def convert_docs(self):
+        """
+        Convert string types to float types.
+        """
+        with self.db.bulk_writer(conf['DB_COLL_DF']) as writer:
+            for doc in self.db.fetch_docs({'$and': [{'STAGE': STAGE_CLEANED},
+                                                    fieldstr_filter(calib_columns)]},
+                                          {},
+                                          conf['DB_COLL_DF']):
+                values = {}
+                for key in calib_columns:
+                    if (type(doc[key]) == str):
+                        values[key] = str_to_float(doc[key])
+                        # update values if necessary
+                if (len(values) > 0):
+                    writer.update({"_id": doc['_id']}, {"$set": values})
+
+    def decode_spectra(self, docs, names):
+        """
+        Decode the spectra (names) of the documents chunk (see
+        Db.doc_spectra). If the chunk can not be decoded, the documents
+        are decoded one by one and only the malformed ones are dropped.
+        Return the decoded documents and their spectra.
+        """
+        try:
+            return docs, self.db.doc_spectra(docs, names)
+        except Exception as e:
+            log.info(f"Exception {e}, decoding the documents one by one")
+        decoded = []
+        for doc in docs:
             try:
-                values['css1'] = css_jirau(doc['rss1_650'], doc['rss1_850'])
-                values['css2'] = css_jirau(doc['rss2_650'], doc['rss2_850'])
+                decoded.append((doc, self.db.doc_spectra([doc], names)))
             except Exception as e:
-                log.info(f"Exception {e}")
-            else:
-                # update the document with the new record values
-                self.db.update_doc({"_id": doc['_id']},
-                                   {"$set": values},
-                                   conf['DB_COLL_DF'])
-            finally:
-                pass
+                log.info(f"Exception {doc['_id']}: {e}")
+        if len(decoded) == 0:
+            return [], {}
+        return ([doc for doc, _ in decoded],
+                {name: np.vstack([s[name] for _, s in decoded])
+                 for name in names})
+
+    def process_intp(self, chunk_size=None, full=False):
+        """
+        Process the linear interpolation for the database data, the
+        documents are fetched and processed in chunks of chunk_size
+        (default, 'PROC_CHUNK_SIZE') documents. Only the cleaned stage
+        documents are processed unless full is set. The products values
+        (see process_css) are written with the spectra in the same
+        update.
+        """
+        chunk_size = chunk_size or conf['PROC_CHUNK_SIZE']
+        filter = {'STAGE': STAGE_CLEANED}
+        if full:
+            filter = self.db.spectra_filter(calib_names[-1])
+        selection = self.db.spectra_selection(calib_names)
+        selection['TIMESTAMP'] = 1
+        cursor = self.db.fetch_docs(filter, selection, conf['DB_COLL_DF'])
+        wm = last = self.db.get_watermark(STAGE_CSS)
+        stage = self.products_stage()
+        with self.db.bulk_writer(conf['DB_COLL_DF']) as writer:
+            for docs in chunks(cursor.batch_size(chunk_size), chunk_size):
+                docs, calib = self.decode_spectra(docs, calib_names)
+                if len(docs) == 0:
+                    continue
+                calib = np.hstack(list(calib.values()))
+                # calculate the interpolation, rss and products values
+                spectra = self.calc_spectra_arr(calib)
+                products = self.calc_products_arr(spectra)
+                # update the documents with the new record values
+                for i, doc in enumerate(docs):
+                    values = {name: spectra[name][i] for name in intp_names}
+                    values = self.db.spectra_values(values)
+                    values.update({name: float(arr[i])
+                                   for name, arr in products.items()})
+                    values['STAGE'] = stage
+                    if last is None or doc['TIMESTAMP'] > last:
+                        last = doc['TIMESTAMP']
+                    writer.update({"_id": doc['_id']}, {"$set": values})
+        # the products are done too, process_css can skip these documents
+        if (len(writer.errors) == 0 and stage == STAGE_CSS and
+                wm is not None and last != wm):
+            self.db.set_watermark(STAGE_CSS, last)
+        pass
 
-    def plot_basic_graph(self, date):
+    def process_css(self, full=False):
         """
-        Plot the base graph (15 to 15 minutes), using the database values.
+        Calculate the products values (see 'PRODUCTS') for the database
+        data. Only the documents newer than the css stage watermark (or
+        still at the interpolated stage) are processed unless full is set,
+        and the documents are updated only when their values changed. The
+        documents reach the css stage only if the css product is selected,
+        a product selected later needs full for the css stage documents.
         """
-        # parse the day range
-        start = datetime.combine(date, time(6, 0, 0))
-        end = datetime.combine(date, time(18, 15, 0))
+        chunk_size = conf['PROC_CHUNK_SIZE']
+        filter = self.db.spectra_filter('rss2')
+        wm = self.db.get_watermark(STAGE_CSS)
+        if not full and wm is not None:
+            filter = {'$and': [filter,
+                               {'$or': [{'STAGE': STAGE_INTP},
+                                        {'TIMESTAMP': {'$gt': wm}}]}]}
+        selection = self.db.spectra_selection(['rss1', 'rss2'])
+        selection.update({'TIMESTAMP': 1, 'STAGE': 1})
+        selection.update({f'{name}{k}': 1 for name in self.bands
+                          for k in (1, 2)})
+        cursor = self.db.fetch_docs(filter, selection, conf['DB_COLL_DF'])
+        last = wm
+        stage = self.products_stage()
+        with self.db.bulk_writer(conf['DB_COLL_DF']) as writer:
+            for docs in chunks(cursor.batch_size(chunk_size), chunk_size):
+                docs, spectra = self.decode_spectra(docs, ['rss1', 'rss2'])
+                if len(docs) == 0:
+                    continue
+                products = self.calc_products_arr(spectra)
+                # update the documents with the new record values
+                for i, doc in enumerate(docs):
+                    values = {name: float(arr[i])
+                              for name, arr in products.items()}
+                    values['STAGE'] = stage
+                    if last is None or doc['TIMESTAMP'] > last:
+                        last = doc['TIMESTAMP']
+                    if all(same_value(doc.get(k), v)
+                           for k, v in values.items()):
+                        continue
+                    writer.update({"_id": doc['_id']}, {"$set": values})
+        # move the watermark forward only if all the batches were written
+        # and the css stage was reached
+        if len(writer.errors) == 0 and stage == STAGE_CSS and last is not None:
+            self.db.set_watermark(STAGE_CSS, last)
+        pass
 
-        docs = [d for d in \
-                self.db.fetch_docs({'TIMESTAMP': {'$gte': start,
-                                                  '$lte': end}},
-                                   get_intp_selection(),
-                                   conf['DB_COLL_DF'])\
-                .sort({'TIMESTAMP': 1})]
+    def init_stages(self):
+        """
+        Tag the processing stage (STAGE) of the documents stored before
+        the stages were maintained by the pipeline.
+        """
+        legacy = {'STAGE': {'$exists': False}}
+        df = self.db.get_coll_df()
+        raw = self.db.get_coll_raw()
+        # the raw documents are cleaned if their copy (same _id) is on
+        # the df collection, the others are left to clean_docs
+        cursor = self.db.fetch_docs(legacy, {'_id': 1}, conf['DB_COLL_RAW'])
+        for ids in chunks((doc['_id'] for doc in cursor),
+                          conf['DB_BATCH_SIZE']):
+            copied = [doc['_id'] for doc in df.find({'_id': {'$in': ids}},
+                                                    {'_id': 1})]
+            raw.update_many({'_id': {'$in': copied}},
+                            {'$set': {'STAGE': STAGE_CLEANED}})
+            raw.update_many({'$and': [{'_id': {'$in': ids}}, legacy]},
+                            {'$set': {'STAGE': STAGE_RAW}})
+        df.update_many({'$and': [legacy, {'css1': {'$exists': True}}]},
+                       {'$set': {'STAGE': STAGE_CSS}})
+        df.update_many({'$and': [legacy, self.db.spectra_filter('rss2')]},
+                       {'$set': {'STAGE': STAGE_INTP}})
+        df.update_many(legacy, {'$set': {'STAGE': STAGE_CLEANED}})
+        pass
 
-        # variation 15 in 15 minutes
-        delta = start + timedelta(minutes=15)
+    def migrate_docs(self, coll=None):
+        """
+        Migrate the documents of the collection (default, 'DB_COLL_DF')
+        from the fields schema to the packed spectra schema.
+        """
+        coll = coll or conf['DB_COLL_DF']
+        self.db.ensure_axis()
+        with self.db.bulk_writer(coll) as writer:
+            for doc in self.db.fetch_docs({SPECTRA: {'$exists': False}},
+                                          {},
+                                          coll):
+                values = {}
+                unset = {}
+                for name, cols in spectra_table.items():
+                    try:
+                        values[SPECTRA + '.' + name] =\
+                            pack_arr([doc[c] for c in cols])
+                    except Exception as e:
+                        continue
+                    else:
+                        unset.update({c: '' for c in cols})
+                if (len(values) > 0):
+                    values['AXIS'] = AXIS
+                    writer.update({"_id": doc['_id']},
+                                  {"$set": values, "$unset": unset})
+        pass
 
-        # save the list of dates and points
-        dates = []
-        point = []
-        points = []
+    def plot_basic_graph(self, date, stat=None):
+        """
+        Plot the base graph (15 to 15 minutes) of the day (date), see
+        plot_basic_range.
+        """
+        start = datetime.combine(date, time(0, 0, 0))
+        self.plot_basic_range(start, start + timedelta(days=1), stat)
 
-        # docs counter
-        i = 0
-        while i < len(docs):
-            if (docs[i]['TIMESTAMP'] <= delta):
-                point.append(docs[i])
-                i += 1
-            else:
-                dates.append(start.strftime("%Y-%m-%d-%H-%M-%S"))
-                points.append(point)
-                start = delta
-                delta = delta + timedelta(minutes=15)
-                point = []
-
-        # for-each list of points, plot the graph
-        for i in range(len(points)):
-            if (len(points[i]) >= 1):
-                self.plot.base_graph(dates[i], points[i])
+    def plot_basic_range(self, start, end, stat=None):
+        """
+        Plot the base graphs (15 to 15 minutes, 06:00 to 18:00) of the
+        days between start and end, using the database values. The
+        buckets are fetched ahead while the pages are rendered, the
+        pages may still be rendering on return (see Plot.join).
+        """
+        stat = stat or conf['PLOT_STAT'] or None
+        for bucket, blocks in prefetch(self.basic_buckets(start,
+                                                          end,
+                                                          15,
+                                                          stat)):
+            self.plot.submit('base_graph',
+                             bucket.strftime("%Y-%m-%d-%H-%M-%S"),
+                             blocks)
         pass
 
-    def plot_daily_graph(self, date):
+    def basic_buckets(self, start, end, minutes=15, stat=None):
         """
-        Plot the daily graph using the database values.
+        Yield the bucket start and the spectra blocks of the documents
+        between start and end (06:00 to 18:00) grouped in buckets of
+        minutes, the grouping runs on the server when it can, else the
+        sorted cursor is streamed one bucket at a time.
         """
-        beg = datetime.combine(date, time(6, 0, 0))
-        end = datetime.combine(date, time(18, 0, 0))
-        docs = [d for d in \
-                self.db.fetch_docs({'TIMESTAMP': {'$gte': beg,
-                                                  '$lte': end}},
-                                   get_daily_selection(),
-                                   conf['DB_COLL_DF'])\
-                .sort({'TIMESTAMP': 1})]
+        filter = {'TIMESTAMP': {'$gte': start, '$lt': end},
+                  # the documents stored before the stages (see init_stages)
+                  '$or': [{'STAGE': {'$in': [STAGE_INTP, STAGE_CSS]}},
+                          {'STAGE': {'$exists': False}}]}
+        filter.update(hours_filter(*day_hours))
+        table = [[key, cols] for key, title, cols in base_graph_table]
 
-        if (len(docs) >= 1):
-            self.plot.daily_graph(date, docs)
+        cursor = None
+        if not self.db.packed():
+            cursor = self.db.aggregate(
+                self.db.bucket_pipeline(filter, table, minutes, stat,
+                                        day_hours[1]),
+                conf['DB_COLL_DF'])
+        if cursor is None:
+            yield from self.stream_buckets(filter, table, minutes, stat)
+            return
+        for doc in cursor:
+            yield doc['_id'], {key: np.asarray(doc[key], dtype='float64')
+                               for key, cols in table}
 
-    def plot_monthly_graph(self):
+    def stream_buckets(self, filter, table, minutes=15, stat=None):
         """
-        Get the docs from the database and plot the SSS graph.
+        Group the sorted documents cursor in buckets of minutes, only one
+        bucket is held in memory. The windows closing sample (see
+        day_hours) joins the last bucket.
         """
-        years  = [2023, 2024]
-        months = [i for i in range(1, 13)]
-        dates = []
+        delta = timedelta(minutes=minutes)
+        close = time(day_hours[1])
 
-        # generate months of the year
-        for year in years:
-            for month in months:
-                dates.append(month_date_pair(year, month))
-            pass
-        pass
+        def bucket(ts):
+            if ts.time() == close:
+                ts = ts - delta
+            day = ts.replace(hour=0, minute=0, second=0, microsecond=0)
+            return day + (ts - day) // delta * delta
 
-        for beg, end in dates:
-            docs = []
-            for doc in self.db.fetch_docs({'TIMESTAMP': {'$gte': beg,
-                                                         '$lte': end}},
-                                          get_css_selection(),
-                                          conf['DB_COLL_DF']):
-                docs.append(doc)
+        cursor = self.db.fetch_docs(filter,
+                                    self.db.selection(get_intp_selection()),
+                                    conf['DB_COLL_DF']).sort('TIMESTAMP', 1)
+        for key, docs in self.group_docs(cursor, bucket):
+            yield key, bucket_blocks(docs, table, stat)
+
+    def group_docs(self, cursor, key):
+        """
+        Split the sorted documents cursor in groups of consecutive
+        documents with the same key(TIMESTAMP) as it streams, yield the
+        key and the group documents. The documents with a None key are
+        skipped.
+        """
+        group = None
+        docs = []
+        for doc in cursor:
+            metrics.count('docs_read')
+            doc = self.db.unpack_doc(doc)
+            k = key(doc['TIMESTAMP'])
+            if k is None:
+                continue
+            if k != group and docs:
+                yield group, docs
+                docs = []
+            group = k
+            docs.append(doc)
+        if docs:
+            yield group, docs
+
+    def plot_daily_graph(self, date):
+        """
+        Plot the daily graph of the day (date), see plot_daily_range.
+        """
+        start = datetime.combine(date, time(0, 0, 0))
+        self.plot_daily_range(start, start + timedelta(days=1))
+
+    def plot_daily_range(self, start, end):
+        """
+        Plot the daily graphs (06:00 to 18:00) of the days between start
+        and end using the database values. A single sorted cursor is
+        split in days as it streams (fetched ahead while the pages are
+        rendered), the pages may still be rendering on return (see
+        Plot.join).
+        """
+        def day(ts):
+            if in_hours(ts, *day_hours):
+                return ts.date()
+            return None
 
-            if (len(docs) >= 1):
-                times = [doc['TIMESTAMP'] for doc in docs]
-                self.plot.monthly_css(beg, end, times, docs)
+        cursor = self.db.fetch_docs({'TIMESTAMP': {'$gte': start,
+                                                   '$lt': end}},
+                                    self.db.selection(get_daily_selection()),
+                                    conf['DB_COLL_DF']).sort('TIMESTAMP', 1)
+
+        for date, docs in prefetch(self.group_docs(cursor, day)):
+            self.plot.submit('daily_graph', date, docs)
         pass
 
-    def process_files(self, files):
+    def plot_monthly_graph(self, start=None, end=None):
         """
-        Given a list of csv files, compute the RRS values over them
-        and persist it using the database module.
+        Get the docs from the database and plot the SSS graph of each
+        month between start and end (default, the data extent), using a
+        single sorted cursor split in months as it streams.
         """
-        # record start time
-        n = len(files)
-        gs = {}
+        coll = conf['DB_COLL_DF']
+        start = start or self.db.first_timestamp(coll)
+        if start is None:
+            return
+        # the extent end is the last document, included
+        end = end or self.db.last_timestamp(coll) + timedelta(milliseconds=1)
 
-        for f in files:
-            ts = basename(f).split('_')[0]
-            gs.setdefault(ts, []).append(file_to_str_io(f))
+        pairs = {}
+        def month(ts):
+            k = (ts.year, ts.month)
+            if k not in pairs:
+                pairs[k] = month_date_pair(ts.year, ts.month)
+            first, last = pairs[k]
+            return k if first <= ts <= last else None
 
-        i = 0
-        for k in list(gs):
-            log.info(f'Processing: {k}: {i + 1}/{len(gs)}')
-            df = pd.DataFrame()
-            for f in gs[k]:
-                tmp = self.read_csv(f)
-                if not tmp.empty and len(tmp) > 1:
-                    df = pd.concat([df, self.process_df(tmp)],
-                                   axis=0,
-                                   ignore_index=True,
-                                   sort=False,
-                                   copy=False)
-            pass
+        cursor = self.db.fetch_docs({'TIMESTAMP': {'$gte': start,
+                                                   '$lt': end}},
+                                    get_css_selection(),
+                                    coll).sort('TIMESTAMP', 1)
+
+        for k, docs in prefetch(self.group_docs(cursor, month)):
+            beg, end = pairs[k]
+            times = [doc['TIMESTAMP'] for doc in docs]
+            self.plot.submit('monthly_css', beg, end, times, docs)
+        pass
+
+    def process_day(self, day, files):
+        """
+        Given the csv files of a day, compute the RRS values over them,
+        plot the day graphs and return a summary of the processing.
+        """
+        summary = {'day': day, 'files': files, 'rows': 0, 'error': None}
+        try:
+            dfs = [pd.DataFrame()]
+            entries = {f: {} for f in files}
+            for f in files:
+                for tmp in self.iter_csv(f, entry=entries[f]):
+                    if not tmp.empty:
+                        dfs.append(self.process_df(tmp))
+            # a file not parsed fails the day, its files are kept
+            failed = [basename(f) for f, entry in entries.items()
+                      if 'error' in entry]
+            if len(failed) > 0:
+                raise IOError(f'files not parsed: {failed}')
+            df = pd.concat(dfs,
+                           axis=0,
+                           ignore_index=True,
+                           sort=False,
+                           copy=False)
 
             # generate the rss of the day
             if not df.empty and len(df) > 1:
                 self.plot.base_graph_from_df(df)
-                # update counter
-            i = i + 1
+                self.plot.join()
+            summary['rows'] = len(df)
+        except Exception as e:
+            summary['error'] = repr(e)
+        finally:
+            return summary
 
-        # move files
-        move_csvs(files)
+    def process_files(self, files, workers=1):
+        """
+        Given a list of csv files, compute the RRS values over them
+        and persist it using the database module. The days are
+        processed by a pool of workers processes when workers > 1.
+        """
+        gs = {}
+        for f in files:
+            ts = basename(f).split('_')[0]
+            gs.setdefault(ts, []).append(f)
+
+        if workers > 1:
+            pool = ProcessPoolExecutor(max_workers=workers)
+            futures = []
+            n = 0
+            try:
+                futures = [pool.submit(process_day, k, gs[k]) for k in gs]
+                # log the progress following the days order
+                for i, future in enumerate(futures):
+                    self.finish_day(future.result(), i, len(gs))
+                    n += 1
+            except KeyboardInterrupt:
+                log.info('Interrupted, cancelling the pending days...')
+                pool.shutdown(wait=False, cancel_futures=True)
+                # keep the days already processed out of order
+                for i, future in enumerate(futures[n:], n):
+                    if (future.done() and not future.cancelled() and
+                            future.exception() is None):
+                        self.finish_day(future.result(), i, len(gs))
+                raise
+            else:
+                pool.shutdown()
+        else:
+            for i, k in enumerate(gs):
+                self.finish_day(self.process_day(k, gs[k]), i, len(gs))
         pass
+
+    def finish_day(self, summary, i, n):
+        """
+        Log the day processing summary and move the files of the day if
+        it succeeded, so an interrupted run does not process it again.
+        """
+        if summary['error'] is None:
+            move_csvs(summary['files'])
+            log.info(f"Processed: {summary['day']}: {i + 1}/{n} "
+                     f"({summary['rows']} rows)")
+        else:
+            log.info(f"Failed: {summary['day']}: {i + 1}/{n} "
+                     f"({summary['error']})")
+        return summary
+
+def process_day(day, files):
+    """
+    Process pool entry point, see Spectroman.process_day.
+    """
+    return Spectroman().process_day(day, files)
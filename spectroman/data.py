@@ -1,21 +1,45 @@
+import os
+import hashlib
 import warnings
+from glob import glob, escape as glob_escape
+from os.path import abspath, dirname, join
 from datetime import datetime
 
 import numpy as np
 import pandas as pd
 
+# wavelengths tables folder
+wl_dat_path = join(dirname(abspath(__file__)), 'wl_dat')
+
 def get_wl_dat(fname):
     """
-    Return np.ndarray with wl_dat data.
-    """
-    fname = 'spectroman/wl_dat/' + fname
-    return np.genfromtxt(fname,
-                         delimiter = '  ',
-                         skip_header = 30,
-                         skip_footer = 60,
-                         dtype = 'float64',
-                         invalid_raise = False,
-                         usecols = 1)
+    Return np.ndarray with wl_dat data, the parsed table is cached as
+    a .npy file next to the .dat file (keyed by its hash).
+    """
+    fname = join(wl_dat_path, fname)
+    with open(fname, 'rb') as f:
+        cache = f'{fname}.{hashlib.sha1(f.read()).hexdigest()[:12]}.npy'
+    try:
+        return np.load(cache)
+    except OSError:
+        pass
+    arr = np.genfromtxt(fname,
+                        delimiter = '  ',
+                        skip_header = 30,
+                        skip_footer = 60,
+                        dtype = 'float64',
+                        invalid_raise = False,
+                        usecols = 1)
+    # the package folder may be read-only
+    try:
+        np.save(cache, arr)
+        # remove the caches of the previous versions of the table
+        for old in glob(f'{glob_escape(fname)}.*.npy'):
+            if old != cache:
+                os.remove(old)
+    except OSError:
+        pass
+    return arr
 
 def wl_dat_5():
     """
@@ -54,17 +78,19 @@ def np_read_from_csv(f):
                             arr = arr[1:]
         return arr
 
-def csv_to_df(csv):
+def csv_to_df(csv, dtype=None, chunksize=None, memory_map=False, skiprows=1):
     """
-    Read csv file and parse it to pandas data frame.
+    Read csv file and parse it to pandas data frame, when chunksize is
+    set an iterator of data frames (chunksize rows each) is returned.
     """
     return pd.read_csv(csv,
                        sep=',',
-                       skiprows=1,
+                       skiprows=skiprows,
                        skip_blank_lines=True,
                        on_bad_lines='error',
-                       # dtype=dtype_dict,
-                       # memory_map=True,
+                       dtype=dtype,
+                       chunksize=chunksize,
+                       memory_map=memory_map,
                        low_memory=False,
                        engine='c',
                        na_values=[-99, '', ' ',
@@ -73,12 +99,77 @@ def csv_to_df(csv):
                                   'Smp', 'TS', 'RN'],
                        keep_default_na=True)
 
+def csv_skiprows(fname, peek=4):
+    """
+    Return the csv file lines to skip: the logger header line and the
+    units/processing lines ("TS", "RN", "Smp", ...) that follow the
+    columns names line.
+    """
+    skip = [0]
+    with open(fname) as f:
+        lines = [f.readline() for _ in range(peek)]
+    for i in range(2, peek):
+        if lines[i].split(',')[0].strip().strip('"') in ('TS', ''):
+            skip.append(i)
+        else:
+            break
+    return skip
+
+def iter_csv(fname, dtype=None, chunksize=None, memory_map=False):
+    """
+    Read the csv file straight from the disk and yield its data frames
+    lazily (the whole file or chunks of chunksize rows). If the file
+    can not be parsed with the dtype map, the remaining rows are parsed
+    again without it.
+    """
+    skip = csv_skiprows(fname)
+    done = 0
+    try:
+        dfs = csv_to_df(fname, dtype, chunksize, memory_map, skip)
+        for df in ([dfs] if chunksize is None else dfs):
+            done += len(df)
+            yield df
+    except ValueError:
+        if dtype is None:
+            raise
+        # skip the data lines already parsed
+        beg = len(skip) + 1
+        skip = skip + list(range(beg, beg + done))
+        dfs = csv_to_df(fname, None, chunksize, memory_map, skip)
+        for df in ([dfs] if chunksize is None else dfs):
+            yield df
+
 def dict_to_df(data):
     """
     Parse the dictionary to Data Frame.
     """
     return pd.DataFrame(data=data, columns=data.keys(), index=[0])
 
+def docs_to_arr(docs, columns, dtype='float64'):
+    """
+    Stack the columns values of the documents (dicts) into a contiguous
+    (len(docs), len(columns)) float array, missing values are NaN.
+    """
+    return np.array([[d.get(c, np.nan) for c in columns] for d in docs],
+                    dtype=dtype)
+
+def bucket_blocks(docs, table, stat=None):
+    """
+    Stack the documents of a bucket into the table [key, cols] blocks,
+    reduced to the bucket mean or median spectrum if stat is set.
+    """
+    blocks = {}
+    for key, cols in table:
+        arr = docs_to_arr(docs, cols)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if stat == 'mean':
+                arr = np.nanmean(arr, axis=0, keepdims=True)
+            elif stat == 'median':
+                arr = np.nanmedian(arr, axis=0, keepdims=True)
+        blocks[key] = arr
+    return blocks
+
 def clean_df(df):
     """
     Remove NA values from the data frame (df).
@@ -94,6 +185,27 @@ def convert_dtypes(df):
     df = df.apply(pd.to_numeric, errors='ignore')
     return clean_df(df)
 
+def str_to_float(value):
+    """
+    Convert a string value to float, keeping only the first decimal
+    point ("1.2.3" is 1.2).
+    """
+    return float('.'.join(value.split('.')[:2]))
+
+def convert_strs(df, columns, dtype='float64'):
+    """
+    Convert the string (object) values left in the columns to float
+    (dtype), keeping only the first decimal point ("1.2.3" is 1.2).
+    """
+    for c in columns:
+        if df[c].dtype == object:
+            df[c] = df[c].astype(str)\
+                         .str.split('.')\
+                         .str[:2]\
+                         .str.join('.')\
+                         .astype(dtype)
+    return df
+
 def convert_datetime(df):
     """
     Convert time stamp string to date time.
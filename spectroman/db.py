@@ -1,28 +1,619 @@
+import time
+import threading
+from contextlib import contextmanager
+
+import numpy as np
 import pymongo
+from bson import Binary
+from pymongo import monitoring, InsertOne, UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError, OperationFailure
 
 from spectroman.log import log
 from spectroman.conf import conf
+from spectroman.metrics import metrics
+from spectroman.data import docs_to_arr
+from spectroman.util import file_entry, file_hash
+from spectroman import const
+from spectroman.const import spectra_table, spectra_names
+
+# packed spectra: key of the spectra sub-document, axis descriptor id
+SPECTRA = 'SPECTRA'
+AXIS = 'spectra_axis'
+
+def pack_arr(arr):
+    """
+    Pack the spectrum values into a float32 (little-endian) binary.
+    """
+    return Binary(np.ascontiguousarray(arr, dtype='<f4').tobytes())
+
+def unpack_arrs(blobs, dtype='float64'):
+    """
+    Decode a list of packed spectra (same length) into a 2-D (dtype)
+    array.
+    """
+    arr = np.frombuffer(b''.join(blobs), dtype='<f4')
+    return arr.reshape(len(blobs), -1).astype(dtype)
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    """
+    Count the connections opened by the client pool.
+    """
+    def __init__(self):
+        self.opened = 0
+        self.closed = 0
+
+    def connection_created(self, event):
+        self.opened += 1
+
+    def connection_closed(self, event):
+        self.closed += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pass
+
+    def connection_checked_out(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+class CommandListener(monitoring.CommandListener):
+    """
+    Record the server round trips (commands) and their latency on the
+    metrics. The reads (cursors batches) latency is also recorded on the
+    db operations stats, if given (see Db.stats).
+    """
+    reads = ['find', 'getMore', 'aggregate']
+
+    def __init__(self, db=None):
+        self.db = db
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event)
+
+    def failed(self, event):
+        metrics.count('db_errors')
+        self.record(event)
+
+    def record(self, event):
+        seconds = event.duration_micros / 1e6
+        metrics.count('db_round_trips')
+        metrics.observe('db_cmd_' + event.command_name, seconds)
+        if self.db is not None and event.command_name in self.reads:
+            self.db.record(event.command_name, seconds)
+
+class BulkWriter:
+    """
+    Buffer write operations (UpdateOne, InsertOne, ...) and flush them
+    with an unordered bulk_write when the buffer reaches the batch size
+    or when the time window has elapsed since the last flush. The
+    callback (if set) is called after each flush with the flush status,
+    the indexes of the operations of that flush that failed are kept on
+    the failed attribute.
+    """
+    def __init__(self, db, coll, size=None, interval=None, callback=None):
+        self.db = db
+        self.callback = callback
+        self.coll = coll
+        self.size = size or conf['DB_BATCH_SIZE']
+        self.interval = interval or conf['DB_BATCH_INTERVAL']
+        self.ops = []
+        self.last = time.monotonic()
+        self.batches = 0
+        self.written = 0
+        self.errors = []
+        self.failed = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def add(self, op):
+        """
+        Add a write operation to the buffer, flush it if necessary.
+        """
+        self.ops.append(op)
+        if (len(self.ops) >= self.size or
+            time.monotonic() - self.last >= self.interval):
+            self.flush()
+        pass
+
+    def insert(self, doc):
+        """
+        Buffer a document insertion.
+        """
+        self.add(InsertOne(doc))
+
+    def update(self, filter, values, upsert=False):
+        """
+        Buffer a document update.
+        """
+        self.add(UpdateOne(filter, values, upsert=upsert))
+
+    def flush(self):
+        """
+        Write the buffered operations using a single round trip and
+        report the batch errors, if any.
+        """
+        self.last = time.monotonic()
+        self.failed = set()
+        if len(self.ops) == 0:
+            if self.callback:
+                self.callback(True)
+            return
+        ops, self.ops = self.ops, []
+        self.batches += 1
+        ok = False
+        try:
+            with metrics.timer('db_write', rows=len(ops)):
+                result = self.db.bulk_write(ops, self.coll)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            self.errors.append({'batch': self.batches,
+                                'ops': len(ops),
+                                'errors': errors})
+            self.written += len(ops) - len(errors)
+            self.failed = {error['index'] for error in errors}
+            log.error(f"Batch {self.batches} on the collection {self.coll}: "
+                      f"{len(errors)} of {len(ops)} operations failed, "
+                      f"first error: {errors[0]['errmsg'] if errors else e}")
+        except Exception as e:
+            self.errors.append({'batch': self.batches,
+                                'ops': len(ops),
+                                'errors': [str(e)]})
+            self.failed = set(range(len(ops)))
+            log.error(f"Batch {self.batches} on the collection {self.coll}: "
+                      f"{len(ops)} operations failed: {e}")
+        else:
+            ok = True
+            self.written += len(ops)
+            log.info(f"Batch {self.batches}: {len(ops)} documents written "
+                     f"on the collection {self.coll}")
+        finally:
+            if self.callback:
+                self.callback(ok)
+
+class Ledger:
+    """
+    Files ingestion ledger: the files already ingested (same size and
+    modification time, or same content hash) are skipped without being
+    parsed. The entries of the ingested files are stored when the
+    writer flushes their rows (see commit).
+    """
+    def __init__(self, db, coll):
+        self.db = db
+        self.coll = coll
+        self.entries = db.fetch_ledger(coll)
+        self.pending = []
+        # entry of the file being buffered
+        self.active = None
+
+    def check(self, fname):
+        """
+        Return the file entry if the file must be ingested, None if it
+        was already ingested.
+        """
+        entry = file_entry(fname)
+        entry.update({'_id': self.coll + ':' + fname, 'coll': self.coll})
+        old = self.entries.get(fname)
+        if old is None or old['status'] != 'done':
+            old = None
+        if (old and
+            old['size'] == entry['size'] and
+            old['mtime'] == entry['mtime']):
+            return None
+        entry['hash'] = file_hash(fname)
+        if old and old['hash'] == entry['hash']:
+            # touched but unchanged file, update its entry
+            entry.update(rows=old['rows'], status='done')
+            self.db.update_ledger([entry])
+            return None
+        entry.update(rows=0, status='pending')
+        self.active = entry
+        return entry
+
+    def add(self, entry):
+        """
+        Add the entry of a file whose rows were all buffered.
+        """
+        self.pending.append(entry)
+        self.active = None
+
+    def track(self, ok):
+        """
+        Writer callback: track the flush status, a failed flush marks
+        the entries of the files whose rows were buffered (pending and
+        active) as failed, they are retried on the next run.
+        """
+        if not ok:
+            for entry in self.pending + [self.active]:
+                if entry is not None:
+                    entry.setdefault('error', 'write failed')
+
+    def commit(self, ok):
+        """
+        Writer callback: store the pending entries once their rows
+        were flushed.
+        """
+        self.track(ok)
+        entries, self.pending = self.pending, []
+        for entry in entries:
+            if 'error' not in entry:
+                entry['status'] = 'done'
+            else:
+                entry['status'] = 'failed'
+            self.entries[entry['path']] = entry
+        try:
+            self.db.update_ledger(entries)
+        except Exception as e:
+            log.info(f"Exception {e}")
 
 class Db:
-    def __init__(self, uri=None, name=None):
+    def __init__(self, uri=None, name=None, pool_size=None,
+                 timeout=None, w=None, schema=None, dtype=None):
         self.uri = uri or conf['DB_URI']
         self.name = name or conf['DB_NAME']
         self.coll_df = conf['DB_COLL_DF']
         self.coll_raw = conf['DB_COLL_RAW']
         self.coll_main = conf['DB_COLL_MAIN']
+        self.pool_size = pool_size or conf['DB_POOL_SIZE']
+        self.timeout = timeout or conf['DB_TIMEOUT_MS']
+        self.w = w or conf['DB_WRITE_CONCERN']
+        self.schema = schema or conf['DB_SCHEMA']
+        self.dtype = dtype or const.float_dtype
         self.client = None
+        self.clients = 0
+        self.pool = PoolListener()
+        self.ops = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def connect(self):
         """
-        Connect with the mongodb and set the attribute client.
+        Connect with the mongodb and set the attribute client, the
+        client (and its connection pool) is created only once and
+        reused by all operations.
+        """
+        if self.client is None:
+            # numeric write concerns are the number of acknowledgements
+            w = int(self.w) if str(self.w).isdigit() else self.w
+            # the reads latency is only known from the commands, the
+            # cursors are lazy (see fetch_docs)
+            listeners = [self.pool, CommandListener(self)]
+            self.client = pymongo.MongoClient(self.uri,
+                                              maxPoolSize=self.pool_size,
+                                              connectTimeoutMS=self.timeout,
+                                              socketTimeoutMS=self.timeout,
+                                              serverSelectionTimeoutMS=self.timeout,
+                                              w=w,
+                                              event_listeners=listeners)
+            self.clients += 1
+        pass
+
+    def close(self):
+        """
+        Close the client and its connection pool.
         """
-        self.client = pymongo.MongoClient(self.uri)
+        if self.client is not None:
+            self.client.close()
+            self.client = None
         pass
 
+    @contextmanager
+    def timed(self, op):
+        """
+        Record the latency of the operation op (also on the metrics).
+        """
+        beg = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - beg
+            self.record(op, seconds)
+            metrics.observe('db_op_' + op, seconds)
+
+    def record(self, op, seconds):
+        """
+        Add the operation op latency to the per-operation stats.
+        """
+        with self.lock:
+            count, total = self.ops.get(op, (0, 0.0))
+            self.ops[op] = (count + 1, total + seconds)
+
+    def stats(self):
+        """
+        Return the clients and connections opened and the per-operation
+        count and latency (seconds), the reads are recorded per server
+        command (find, getMore and aggregate).
+        """
+        ops = {}
+        for op, (count, total) in self.ops.items():
+            ops[op] = {'count': count,
+                       'total': total,
+                       'mean': total / count}
+        return {'clients': self.clients,
+                'connections': self.pool.opened,
+                'connections_closed': self.pool.closed,
+                'ops': ops}
+
+    def packed(self):
+        """
+        Return True if the spectra are stored as packed arrays.
+        """
+        return self.schema == 'packed'
+
+    def selection(self, selection):
+        """
+        Adapt a fields projection to the storage schema, the spectra
+        columns are replaced by their packed spectrum.
+        """
+        if not self.packed():
+            return selection
+        dict = {}
+        for k, v in selection.items():
+            if k in spectra_names:
+                k = SPECTRA + '.' + spectra_names[k]
+            dict[k] = v
+        return dict
+
+    def spectra_selection(self, names):
+        """
+        Return the projection of the spectra (names) and _id.
+        """
+        dict = {'_id': 1}
+        for name in names:
+            if self.packed():
+                dict[SPECTRA + '.' + name] = 1
+            else:
+                for c in spectra_table[name]:
+                    dict[c] = 1
+        return dict
+
+    def spectra_filter(self, name, exists=True):
+        """
+        Return the filter of the documents where the spectrum (name)
+        exists (or not).
+        """
+        if self.packed():
+            return {SPECTRA + '.' + name: {'$exists': exists}}
+        filter = [{c: {'$exists': exists}} for c in spectra_table[name]]
+        return {'$and' if exists else '$or': filter}
+
+    def spectra_values(self, spectra, nested=False):
+        """
+        Given the spectra (name: values), return the document values
+        ($set or, if nested, the document fields) using the storage
+        schema.
+        """
+        values = {}
+        for name, arr in spectra.items():
+            if self.packed():
+                values[SPECTRA + '.' + name] = pack_arr(arr)
+            else:
+                values.update(zip(spectra_table[name], np.asarray(arr).tolist()))
+        if self.packed():
+            values['AXIS'] = AXIS
+            if nested:
+                values = {SPECTRA: {k.split('.')[1]: v for k, v in
+                                    values.items() if k != 'AXIS'},
+                          'AXIS': AXIS}
+        return values
+
+    def doc_spectra(self, docs, names):
+        """
+        Decode the spectra (names) of the documents into 2-D arrays,
+        return a dict (name: (len(docs), len(wl)) array).
+        """
+        spectra = {}
+        for name in names:
+            if self.packed():
+                spectra[name] = unpack_arrs([d[SPECTRA][name] for d in docs],
+                                            self.dtype)
+            else:
+                spectra[name] = docs_to_arr(docs, spectra_table[name],
+                                            self.dtype)
+        return spectra
+
+    def unpack_doc(self, doc):
+        """
+        Expand the packed spectra of the document into fields.
+        """
+        packed = doc.pop(SPECTRA, {})
+        doc.pop('AXIS', None)
+        for name, blob in packed.items():
+            doc.update(zip(spectra_table[name],
+                           unpack_arrs([blob])[0].tolist()))
+        return doc
+
+    def fetch_spectra(self, filter, names, coll):
+        """
+        Fetch the documents spectra (names), return the documents
+        (_id and TIMESTAMP) and the spectra as 2-D arrays.
+        """
+        selection = self.spectra_selection(names)
+        selection['TIMESTAMP'] = 1
+        filter = {'$and': [filter] +
+                  [self.spectra_filter(name) for name in names]}
+        with metrics.timer('db_read') as t:
+            docs = list(self.fetch_docs(filter, selection, coll)
+                        .sort('TIMESTAMP', 1))
+            t.rows = len(docs)
+        spectra = self.doc_spectra(docs, names)
+        return [{'_id': d['_id'], 'TIMESTAMP': d.get('TIMESTAMP')}
+                for d in docs], spectra
+
+    def bucket_pipeline(self, filter, table, minutes=15, stat=None,
+                        close=None):
+        """
+        Return the aggregation grouping the documents (filter) in buckets
+        of minutes, each table [key, cols] entry becomes a 2-D array
+        (samples or the bucket mean/median spectrum). The documents at
+        the close hour (the windows closing edge) join the last bucket.
+        """
+        date = '$TIMESTAMP'
+        if close is not None:
+            date = {'$cond': [{'$eq': [{'$hour': '$TIMESTAMP'}, close]},
+                              {'$subtract': ['$TIMESTAMP',
+                                             minutes * 60 * 1000]},
+                              '$TIMESTAMP']}
+        group = {'_id': {'$dateTrunc': {'date': date,
+                                        'unit': 'minute',
+                                        'binSize': minutes}}}
+        project = {}
+        for key, cols in table:
+            if stat is None:
+                group[key] = {'$push': ['$' + c for c in cols]}
+                project[key] = 1
+                continue
+            for c in cols:
+                if stat == 'median':
+                    group[c] = {'$median': {'input': '$' + c,
+                                            'method': 'approximate'}}
+                else:
+                    group[c] = {'$avg': '$' + c}
+            project[key] = [['$' + c for c in cols]]
+        return [{'$match': filter},
+                {'$sort': {'TIMESTAMP': 1}},
+                {'$group': group},
+                {'$project': project},
+                {'$sort': {'_id': 1}}]
+
+    def ensure_axis(self):
+        """
+        Store the spectra wavelengths axis descriptor on the main
+        collection.
+        """
+        axis = {name: np.asarray(wl).tolist()
+                for name, wl in const.spectra_axis.items()}
+        self.get_coll_main().replace_one({'_id': AXIS}, axis, upsert=True)
+
+    def last_timestamp(self, coll):
+        """
+        Return the newest document TIMESTAMP of the collection, None if
+        the collection is empty.
+        """
+        doc = self.get_coll(coll).find_one({}, {'TIMESTAMP': 1},
+                                           sort=[('TIMESTAMP', -1)])
+        return doc['TIMESTAMP'] if doc else None
+
+    def first_timestamp(self, coll):
+        """
+        Return the oldest document TIMESTAMP of the collection, None if
+        the collection is empty.
+        """
+        doc = self.get_coll(coll).find_one({'TIMESTAMP': {'$exists': True}},
+                                           {'TIMESTAMP': 1},
+                                           sort=[('TIMESTAMP', 1)])
+        return doc['TIMESTAMP'] if doc else None
+
+    def get_watermark(self, stage):
+        """
+        Return the stage high-water mark (last processed TIMESTAMP)
+        stored on the main collection, None if not set.
+        """
+        doc = self.get_coll_main().find_one({'_id': 'watermark_' + stage})
+        return doc['TIMESTAMP'] if doc else None
+
+    def set_watermark(self, stage, timestamp):
+        """
+        Store the stage high-water mark on the main collection.
+        """
+        self.get_coll_main().update_one({'_id': 'watermark_' + stage},
+                                        {'$set': {'TIMESTAMP': timestamp}},
+                                        upsert=True)
+
+    def ensure_indexes(self):
+        """
+        Create the collections indexes: unique TIMESTAMP and
+        (STAGE, TIMESTAMP) on the df and raw collections, and the spectra
+        axis descriptor for the packed schema. Return the indexes that
+        could not be created (collection, keys, error), the unique index
+        fails on a collection holding duplicated TIMESTAMP documents.
+        """
+        if self.packed():
+            self.ensure_axis()
+        failed = []
+        for coll in [self.coll_df, self.coll_raw]:
+            for keys, unique in [([('TIMESTAMP', 1)], True),
+                                 ([('STAGE', 1), ('TIMESTAMP', 1)], False)]:
+                try:
+                    with self.timed('ensure_indexes'):
+                        self.get_coll(coll).create_index(keys, unique=unique)
+                except OperationFailure as e:
+                    failed.append((coll, keys, e))
+                    if unique:
+                        dups = self.duplicate_timestamps(coll)
+                        log.error(f"Index {keys} of {coll} not created, "
+                                  f"{len(dups)} TIMESTAMP values are "
+                                  f"duplicated (e.g. {dups[:3]}): remove "
+                                  f"the duplicated documents and run the "
+                                  f"indexing again ({e})")
+                    else:
+                        log.error(f"Index {keys} of {coll} not created "
+                                  f"({e})")
+        return failed
+
+    def duplicate_timestamps(self, coll):
+        """
+        Return the TIMESTAMP values shared by more than one document of
+        the collection.
+        """
+        pipeline = [{'$group': {'_id': '$TIMESTAMP', 'n': {'$sum': 1}}},
+                    {'$match': {'n': {'$gt': 1}}},
+                    {'$sort': {'_id': 1}}]
+        return [d['_id'] for d in self.aggregate(pipeline, coll) or []]
+
+    def fetch_ledger(self, coll):
+        """
+        Return the ingestion ledger entries of the files ingested into
+        the collection (file path: entry).
+        """
+        return {d['path']: d for d in
+                self.fetch_docs({'coll': coll}, {}, conf['DB_COLL_LEDGER'])}
+
+    def update_ledger(self, entries):
+        """
+        Store (upsert) the ingestion ledger entries.
+        """
+        if len(entries) > 0:
+            self.bulk_write([ReplaceOne({'_id': e['_id']}, e, upsert=True)
+                             for e in entries],
+                            conf['DB_COLL_LEDGER'])
+
     def get_db(self):
         """
         Return database name.
         """
+        self.connect()
         return self.client[self.name]
 
     def get_coll(self, coll):
@@ -52,8 +643,8 @@ class Db:
         Insert document into the collection.
         """
         try:
-            self.connect()
-            self.get_coll(coll).insert_one(doc)
+            with self.timed('insert_doc'):
+                self.get_coll(coll).insert_one(doc)
         except Exception as e:
             log.info(f"Exception {e}")
         else:
@@ -66,8 +657,8 @@ class Db:
         Insert documents into the collection.
         """
         try:
-            self.connect()
-            self.get_coll(coll).insert_many(docs)
+            with self.timed('insert_docs'):
+                self.get_coll(coll).insert_many(docs)
         except Exception as e:
             log.info(f"Exception {e}")
         else:
@@ -80,8 +671,8 @@ class Db:
         Update collection document values.
         """
         try:
-            self.connect()
-            self.get_coll(coll).update_one(filter, values)
+            with self.timed('update_doc'):
+                self.get_coll(coll).update_one(filter, values)
         except Exception as e:
             log.info(f"Exception {e}")
         else:
@@ -89,13 +680,26 @@ class Db:
         finally:
             pass
 
+    def bulk_write(self, ops, coll):
+        """
+        Write the operations using an unordered bulk_write, errors are
+        raised to the caller (see BulkWriter).
+        """
+        with self.timed('bulk_write'):
+            return self.get_coll(coll).bulk_write(ops, ordered=False)
+
+    def bulk_writer(self, coll, size=None, interval=None, callback=None):
+        """
+        Return a BulkWriter for the collection.
+        """
+        return BulkWriter(self, coll, size, interval, callback)
+
     def fetch_docs(self, filter, projection, coll):
         """
         Fetch documents, this method returns a cursor iterable.
         """
         cursor = None
         try:
-            self.connect()
             cursor = self.get_coll(coll).find(filter, projection)
         except Exception as e:
             log.info(f"Exception {e}")
@@ -104,13 +708,29 @@ class Db:
         finally:
             return cursor
 
+    def aggregate(self, pipeline, coll):
+        """
+        Run the aggregation pipeline, this method returns a cursor
+        iterable or None if the server refused it.
+        """
+        cursor = None
+        try:
+            cursor = self.get_coll(coll).aggregate(pipeline,
+                                                   allowDiskUse=True)
+        except Exception as e:
+            log.info(f"Exception {e}")
+        else:
+            pass
+        finally:
+            return cursor
+
     def remove_doc(self, filter, collation, column):
         """
         Remove document using the proper filter.
         """
         try:
-            self.connect()
-            self.get_coll(column).delete_one(filter, collation)
+            with self.timed('remove_doc'):
+                self.get_coll(column).delete_one(filter, collation)
         except Exception as e:
             log.info(f"Exception {e}")
         else:
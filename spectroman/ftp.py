@@ -1,28 +1,86 @@
+import os
+import json
 import ftplib
-from os.path import basename, exists, join
-from datetime import datetime
+import queue
+from os.path import basename, exists, getsize, join
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from spectroman.conf import conf
 from spectroman.log import log
+from spectroman.metrics import metrics
 
 class Ftp:
-    def __init__(self, host=None, path=None, user=None, passwd=None):
+    def __init__(self, host=None, path=None, user=None, passwd=None,
+                 port=None, workers=None, output=None, manifest=None):
         self.ftp = None
         self.host = host or conf['FTP_HOST']
+        self.port = port or conf['FTP_PORT']
         self.user = user or conf['FTP_USER']
         self.path = path or conf['FTP_PATH']
         self.passwd = passwd or conf['FTP_PASS']
+        self.workers = workers or conf['FTP_WORKERS']
+        self.output = output or conf['DATA_OUTPUT']
+        # the partial downloads, kept apart from the csvs (see download)
+        self.partial = join(self.output, '.partial')
+        self.manifest = manifest or conf['FTP_MANIFEST']
+        self.idle = queue.Queue()
+        self.callback = None
 
     def connect(self):
         """
         Connect to the FTP host.
         """
-        self.ftp = ftplib.FTP(host=self.host, timeout=60)
-        # ftp login
-        self.ftp.login(user=self.user, passwd=self.passwd)
+        self.ftp = self.open()
         # return void
         pass
 
+    def open(self):
+        """
+        Open and return a new logged in FTP connection.
+        """
+        ftp = ftplib.FTP(timeout=60)
+        ftp.connect(host=self.host, port=self.port)
+        # ftp login
+        ftp.login(user=self.user, passwd=self.passwd)
+        return ftp
+
+    def ping(self):
+        """
+        Check the FTP connection, reconnect if it was lost.
+        """
+        try:
+            self.ftp.voidcmd('NOOP')
+        except Exception as e:
+            self.connect()
+        pass
+
+    def acquire(self):
+        """
+        Return an idle workers connection, or a new one.
+        """
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.open()
+
+    def release(self, ftp):
+        """
+        Give the workers connection back to the idle ones.
+        """
+        self.idle.put(ftp)
+
+    def close(self):
+        """
+        Close the idle workers connections.
+        """
+        while not self.idle.empty():
+            ftp = self.idle.get_nowait()
+            try:
+                ftp.quit()
+            except Exception as e:
+                ftp.close()
+        pass
+
     def files_list(self, path=None, sort_recent=True):
         """
         Return a file list from path (default, 'FTP_PATH') from
@@ -34,32 +92,170 @@ class Ftp:
         self.ftp.cwd(path)
         # convert file string to file list, remove the last element
         self.ftp.retrlines('NLST', lambda s : files.append(s))
-        # if sort recent is set to false return files
+        # if sort recent is set to false return files, the names
+        # (%Y-%m-%d_%H-%M-%S) sort as their dates
         if sort_recent:
-            files.sort(key=lambda s: datetime.strptime(s.split('.')[0],
-                                                       '%Y-%m-%d_%H-%M-%S'))
+            files.sort()
         return files
 
+    def files_entries(self, path=None):
+        """
+        Return the files entries (name: {size, modify}) from path
+        (default, 'FTP_PATH') using MLSD, or NLST, SIZE and MDTM if
+        the server does not support it.
+        """
+        path = path or self.path
+        self.ftp.cwd(path)
+        entries = {}
+        try:
+            for name, facts in self.ftp.mlsd(facts=['type', 'size', 'modify']):
+                if facts.get('type', 'file') == 'file':
+                    entries[name] = {'size': int(facts.get('size', -1)),
+                                     'modify': facts.get('modify')}
+        except ftplib.error_perm:
+            for name in self.files_list(path, sort_recent=False):
+                entries[name] = {'size': self.ftp.size(name),
+                                 'modify': self.ftp.voidcmd('MDTM ' + name)
+                                                   .split()[-1]}
+        return entries
+
+    def load_manifest(self):
+        """
+        Return the local manifest (name: {size, modify}) of the files
+        already downloaded.
+        """
+        if not exists(self.manifest):
+            return {}
+        with open(self.manifest) as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest):
+        """
+        Save the local manifest (atomically).
+        """
+        tmp = self.manifest + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self.manifest)
+
+    def download(self, name, size=-1, path=None, modify=None):
+        """
+        Download the file into a temporary (.part) file on the partial
+        folder, resuming a previous partial download (REST) of the same
+        remote version (size and modify time, kept on a .part.json
+        file), and rename it atomically when it is complete. Return the
+        saved file path.
+        """
+        fname = join(self.output, name)
+        os.makedirs(self.partial, exist_ok=True)
+        tmp = join(self.partial, name + '.part')
+        version = {'size': size, 'modify': modify}
+        # a partial download of another (or unknown) version starts over
+        if exists(tmp) and (size < 0 or self.part_version(tmp) != version):
+            os.remove(tmp)
+        if not exists(tmp):
+            with open(tmp + '.json', 'w') as f:
+                json.dump(version, f)
+        offset = getsize(tmp) if exists(tmp) else 0
+        if size >= 0 and offset > size:
+            offset = 0
+        if size < 0 or offset < size:
+            ftp = self.acquire()
+            try:
+                with metrics.timer('ftp_transfer') as t, \
+                     open(tmp, 'ab' if offset > 0 else 'wb') as f:
+                    ftp.retrbinary('RETR ' + join(path or self.path, name),
+                                   f.write,
+                                   rest=offset or None)
+                    t.nbytes = f.tell() - offset
+            except Exception as e:
+                # drop the connection, it may be broken
+                ftp.close()
+                raise
+            else:
+                self.release(ftp)
+        if size >= 0 and getsize(tmp) != size:
+            raise IOError(f'{name}: {getsize(tmp)} of {size} bytes received')
+        os.replace(tmp, fname)
+        os.remove(tmp + '.json')
+        return fname
+
+    def part_version(self, tmp):
+        """
+        Return the remote version (size and modify time) of the partial
+        download tmp, None if unknown.
+        """
+        try:
+            with open(tmp + '.json') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def sync(self, path=None, callback=None, keep=False):
+        """
+        Download the new or changed files (regarding the manifest) from
+        path (default, 'FTP_PATH') over a pool of FTP connections, the
+        callback (default, the callback attribute) is called with each
+        saved file path. The workers connections are kept open for the
+        next sync if keep is set.
+        """
+        path = path or self.path
+        callback = callback or self.callback
+        entries = self.files_entries(path)
+        manifest = self.load_manifest()
+        todo = []
+        for name in sorted(entries):
+            entry = entries[name]
+            if manifest.get(name) == entry:
+                continue
+            # files downloaded before the manifest existed
+            if (name not in manifest and
+                exists(join(conf['DATA_BACKUP'], name)) and
+                getsize(join(conf['DATA_BACKUP'], name)) == entry['size']):
+                manifest[name] = entry
+                continue
+            todo.append(name)
+        log.info(f'{len(entries)} total files found, {len(todo)} to download...')
+
+        saved = []
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            futures = {pool.submit(self.download,
+                                   name,
+                                   entries[name]['size'],
+                                   path,
+                                   entries[name]['modify']): name
+                       for name in todo}
+            for i, future in enumerate(as_completed(futures)):
+                name = futures[future]
+                try:
+                    fname = future.result()
+                except Exception as e:
+                    log.info(f'Exception {name}: {e}')
+                    continue
+                log.info(f'Downloaded {i + 1} of {len(todo)}: {name}')
+                manifest[name] = entries[name]
+                saved.append(fname)
+                if callback:
+                    callback(fname)
+                if len(saved) % 100 == 0:
+                    self.save_manifest(manifest)
+        finally:
+            pool.shutdown(cancel_futures=True)
+            if not keep:
+                self.close()
+            self.save_manifest(manifest)
+        return saved
+
     def fetch_files(self, path=None):
         """
         Fetch files from FTP path (default, 'FTP_PATH') and save it
-        at 'DATA_OUTPUT' set on settings.ini.
-        """
-        files = self.files_list()
-        total = len(files)
-        log.info(f'{total} total files found...')
-        log.info('Attempting to copy...')
-        for i, f in enumerate(files):
-            if not exists(join(conf['DATA_BACKUP'], f)):
-                print(f'Downloading {i + 1} of {total}: {f}...')
-                print(f'Saving copy at: {f}')
-                self.ftp.retrbinary('RETR ' + f,
-                                    open(join(conf['DATA_OUTPUT'], f), 'wb').write)
-            else:
-                print(f'File already cached: {f}')
-        pass
+        at 'DATA_OUTPUT' set on settings.ini, only the new or changed
+        files are downloaded (see sync).
+        """
+        files = self.sync(path)
         self.ftp.quit()
-        pass
+        return files
 
     def update_files(self, path=None):
         pass
@@ -1,5 +1,6 @@
 import os
 import logging
+import threading
 from datetime import datetime
 
 from spectroman.conf import conf
@@ -45,4 +46,20 @@ def log_init():
     log.set_console_log_handler()
     return log.get_log()
 
-log = log_init()
+class LazyLog():
+    """
+    Logger proxy, the logger (and its log file) is created on the
+    first use.
+    """
+    def __init__(self):
+        self.log = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self.log is None:
+            with self.lock:
+                if self.log is None:
+                    self.log = log_init()
+        return getattr(self.log, name)
+
+log = LazyLog()
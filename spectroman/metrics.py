@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+
+from spectroman.conf import conf
+
+class Timer:
+    """
+    Time a stage block, the rows and bytes processed can be set on the
+    timer inside the block.
+    """
+    __slots__ = ('metrics', 'name', 'rows', 'nbytes', 'beg')
+
+    def __init__(self, metrics, name, rows=0, nbytes=0):
+        self.metrics = metrics
+        self.name = name
+        self.rows = rows
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.beg = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.name,
+                             time.perf_counter() - self.beg,
+                             self.rows,
+                             self.nbytes)
+
+class NullTimer:
+    """
+    Disabled timer, it does nothing.
+    """
+    rows = 0
+    nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+null_timer = NullTimer()
+
+class Metrics:
+    """
+    Per-stage timers (count, seconds, rows, bytes and the latency of the
+    last samples for the p50/p99) and counters, exported as a JSON
+    snapshot or a Prometheus text file. When disabled (see 'METRICS')
+    the timers and counters are no-ops.
+    """
+    def __init__(self, enabled=None, output=None, samples=1024):
+        self.enabled = conf['METRICS'] if enabled is None else enabled
+        self.output = output or conf['METRICS_OUTPUT']
+        self.samples = samples
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.timers = {}
+        self.counters = {}
+
+    def timer(self, name, rows=0, nbytes=0):
+        """
+        Return the timer (context manager) of the stage name.
+        """
+        if not self.enabled:
+            return null_timer
+        return Timer(self, name, rows, nbytes)
+
+    def observe(self, name, seconds, rows=0, nbytes=0):
+        """
+        Record a sample of the stage name.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            t = self.timers.get(name)
+            if t is None:
+                t = self.timers[name] = {'count': 0, 'seconds': 0.0,
+                                         'rows': 0, 'bytes': 0,
+                                         'samples': []}
+            t['count'] += 1
+            t['seconds'] += seconds
+            t['rows'] += rows
+            t['bytes'] += nbytes
+            t['samples'].append(seconds)
+            # keep the last samples only
+            if len(t['samples']) > 2 * self.samples:
+                del t['samples'][:-self.samples]
+
+    def count(self, name, n=1):
+        """
+        Increment the counter name.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        """
+        Return the timers (with rows/s, bytes/s, p50 and p99 latency)
+        and the counters.
+        """
+        timers = {}
+        with self.lock:
+            for name, t in self.timers.items():
+                samples = sorted(t['samples'])
+                seconds = t['seconds']
+                timers[name] = {
+                    'count': t['count'],
+                    'seconds': seconds,
+                    'rows': t['rows'],
+                    'bytes': t['bytes'],
+                    'rows_s': t['rows'] / seconds if seconds else 0.0,
+                    'bytes_s': t['bytes'] / seconds if seconds else 0.0,
+                    'p50': percentile(samples, 0.50),
+                    'p99': percentile(samples, 0.99)}
+            counters = dict(self.counters)
+        return {'time': datetime.now().isoformat(timespec='seconds'),
+                'uptime': time.time() - self.start,
+                'timers': timers,
+                'counters': counters}
+
+    def prometheus(self, snapshot):
+        """
+        Return the snapshot in the Prometheus text format.
+        """
+        lines = ['# TYPE spectroman_stage_seconds summary']
+        for name, t in snapshot['timers'].items():
+            label = f'stage="{name}"'
+            lines += [f'spectroman_stage_seconds{{{label},quantile="0.5"}} '
+                      f'{t["p50"]}',
+                      f'spectroman_stage_seconds{{{label},quantile="0.99"}} '
+                      f'{t["p99"]}',
+                      f'spectroman_stage_seconds_sum{{{label}}} {t["seconds"]}',
+                      f'spectroman_stage_seconds_count{{{label}}} {t["count"]}']
+        lines.append('# TYPE spectroman_stage_rows_total counter')
+        for name, t in snapshot['timers'].items():
+            lines.append(f'spectroman_stage_rows_total{{stage="{name}"}} '
+                         f'{t["rows"]}')
+        lines.append('# TYPE spectroman_stage_bytes_total counter')
+        for name, t in snapshot['timers'].items():
+            lines.append(f'spectroman_stage_bytes_total{{stage="{name}"}} '
+                         f'{t["bytes"]}')
+        for name, value in snapshot['counters'].items():
+            lines += [f'# TYPE spectroman_{name}_total counter',
+                      f'spectroman_{name}_total {value}']
+        return '\n'.join(lines) + '\n'
+
+    def export(self, fname=None):
+        """
+        Write the snapshot (atomically) as a Prometheus text file if
+        fname (default, 'METRICS_OUTPUT') ends with .prom, else as JSON.
+        """
+        if not self.enabled:
+            return
+        fname = fname or self.output
+        snapshot = self.snapshot()
+        tmp = fname + '.tmp'
+        with open(tmp, 'w') as f:
+            if fname.endswith('.prom'):
+                f.write(self.prometheus(snapshot))
+            else:
+                json.dump(snapshot, f, indent=2)
+        os.replace(tmp, fname)
+
+def percentile(samples, q):
+    """
+    Return the q percentile of the sorted samples (nearest rank).
+    """
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+metrics = Metrics()
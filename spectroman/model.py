@@ -1,6 +1,5 @@
 import math
 import numpy as np
-from scipy.interpolate import griddata
 
 from spectroman.conf import *
 
@@ -10,11 +9,46 @@ def linear_intp(s, wl, set):
     linear interpolation using the pre defined [set] and
     [wl] data.
     """
+    from scipy.interpolate import griddata
     return griddata(wl,
                     np.array(s),
                     set,
                     method='linear')
 
+def linear_intp_op(wl, set):
+    """
+    Build the sparse linear interpolation operator that maps the
+    [wl] wavelengths to the [set] wavelengths, i.e., a (len(wl), len(set))
+    weight matrix W so that the interpolation of a rows block X is X @ W.
+    Targets outside the [wl] range hold a single NaN weight, so the
+    product yields NaN there (the same as griddata).
+    """
+    from scipy.sparse import csr_matrix
+    wl = np.asarray(wl, dtype='float64')
+    set = np.asarray(set, dtype='float64')
+    # griddata sorts the points before the interpolation
+    order = np.argsort(wl)
+    wl = wl[order]
+    # index of the lower neighbour of each target
+    lo = np.clip(np.searchsorted(wl, set, side='right') - 1, 0, len(wl) - 2)
+    hi = lo + 1
+    w = (set - wl[lo]) / (wl[hi] - wl[lo])
+    out = (set < wl[0]) | (set > wl[-1])
+    cols = np.arange(len(set))
+    rows = np.concatenate([order[lo[~out]], order[hi[~out]], order[lo[out]]])
+    data = np.concatenate([1.0 - w[~out], w[~out],
+                           np.full(out.sum(), np.nan)])
+    cols = np.concatenate([cols[~out], cols[~out], cols[out]])
+    return csr_matrix((data, (rows, cols)), shape=(len(wl), len(set)))
+
+def linear_intp_arr(arr, op):
+    """
+    Given a 2-D block [arr] (rows x len(wl)) compute the linear
+    interpolation of all rows at once using the operator [op]
+    built by linear_intp_op, in the [op] precision.
+    """
+    return np.asarray(np.asarray(arr, dtype=op.dtype) @ op)
+
 def calc_reflectance(ed, ld, lu, rho=0.028):
     """
     Compute the reflectance.
@@ -38,6 +72,19 @@ def calc_rrs_reflectance(lst):
     return np.apply_along_axis(
         lambda x: calc_reflectance(x[0], x[1], x[2]), 0, arr)
 
+def calc_rrs_arr(ed, ld, lu, rho=0.028, dtype='float64'):
+    """
+    Given the (n_rows, n_wl) blocks [ed, ld, lu], compute the rss
+    reflectance of all rows at once in [dtype] precision. The [rho]
+    value is broadcast against the blocks: a scalar, a per-row
+    (n_rows, 1) or a per-wavelength (n_wl,) array.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return calc_reflectance(np.asarray(ed, dtype=dtype),
+                                np.asarray(ld, dtype=dtype),
+                                np.asarray(lu, dtype=dtype),
+                                np.asarray(rho, dtype=dtype))
+
 def css_jirau(rrs_650, rrs_850):
     "Compute css_jirau using a list of values [rrs850, rrs650]."
     return 13.294 * np.exp((rrs_850 / rrs_650) * 5.2532)
@@ -71,3 +118,42 @@ def find_nearest(array, value):
     array = np.asarray(array)
     index = (np.abs(array - value)).argmin()
     return index
+
+# water quality products: name -> [model, bands wavelengths (nm)], the
+# model is called with the rss of each band (in order), see calc_products
+products_table = {'css': [css_jirau, [650, 850]],
+                  'chla': [chla_gitelson, [665, 715, 750]],
+                  'spm': [nechad, [700]],
+                  'cdom': [castillo, [510, 670]]}
+
+def product_bands(names, wl):
+    """
+    Resolve once the band indices (the closest [wl] wavelengths) of the
+    [names] products, raise ValueError if a name is not registered on
+    the products_table.
+    """
+    unknown = [name for name in names if name not in products_table]
+    if unknown:
+        raise ValueError(f"PRODUCTS: unknown products {unknown}, the "
+                         f"products are: {', '.join(products_table)}")
+    return {name: [find_nearest(wl, band) for band in products_table[name][1]]
+            for name in names}
+
+def calc_products(rss, bands):
+    """
+    Given a list of (n_rows, len(wl)) rss blocks (one per radiometers
+    pair) and the resolved [bands] (see product_bands), compute the
+    products of all pairs and rows in one pass. Return the (product
+    name + pair number, e.g. css1) values dictionary.
+    """
+    idx = sorted({i for band in bands.values() for i in band})
+    pos = {i: k for k, i in enumerate(idx)}
+    # (n_pairs, n_rows, n_bands) block of the used bands only
+    sub = np.stack([np.asarray(r)[:, idx] for r in rss])
+    values = {}
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for name, band in bands.items():
+            out = products_table[name][0](*(sub[:, :, pos[i]] for i in band))
+            for k in range(len(rss)):
+                values[f'{name}{k + 1}'] = out[k]
+    return values
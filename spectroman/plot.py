@@ -1,15 +1,34 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.dates as pltdates
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import timedelta
 
 from spectroman.log import log
+from spectroman.metrics import metrics
 from spectroman.const import *
 from spectroman.conf import conf
+from spectroman.data import docs_to_arr
+
+# matplotlib is imported by the renderers on demand (startup time)
 
 class Plot:
-    def __init__(self):
-        pass
+    def __init__(self, dpi=None, fmt=None, workers=None):
+        self.dpi = dpi or conf['PLOT_DPI']
+        self.fmt = fmt or conf['PLOT_FORMAT']
+        self.workers = workers or conf['PLOT_WORKERS']
+        # figures layouts, built once and updated for every page
+        self.layouts = {}
+        # constrained layouts solved (figure: layout key)
+        self.solved = {}
+        self.pool = None
+        self.pending = {}
+        self.cache = PlotCache(conf['PLOT_OUTPUT'] + conf['PLOT_CACHE']
+                               if conf['PLOT_CACHE'] else None)
+        self.skipped = 0
 
     def plot_values(self, axs, title, x, y, fmt=""):
         """
@@ -22,39 +41,117 @@ class Plot:
         """
         Save figure using the figure object and its file name.
         """
-        fig.savefig(fname, dpi=200)
+        from matplotlib.layout_engine import ConstrainedLayoutEngine
+        fname = f'{fname}.{self.fmt}'
+        # a solved layout is kept for the next pages, it is solved again
+        # only when the titles or the ticks labels lengths changed
+        key = self.layout_key(fig)
+        if fig in self.solved and self.solved[fig] != key:
+            fig.set_layout_engine('constrained')
+        fig.savefig(fname, dpi=self.dpi, format=self.fmt)
+        if isinstance(fig.get_layout_engine(), ConstrainedLayoutEngine):
+            # the ticks follow the solved axes sizes
+            self.solved[fig] = self.layout_key(fig)
+            fig.set_layout_engine('none')
         log.info(f'{fname} saved')
-        plt.close()
         pass
 
-    def base_graph(self, dts, docs):
+    def layout_key(self, fig):
+        """
+        Return the sizes of the figure texts that size its layout: the
+        titles and the axes ticks labels lengths (the digits have the
+        same width, a new timestamp keeps the layout) and the offsets.
+        """
+        key = [len(fig._suptitle.get_text()) if fig._suptitle else None]
+        for ax in fig.axes:
+            key.append(len(ax.get_title()))
+            for axis in [ax.xaxis, ax.yaxis]:
+                formatter = axis.get_major_formatter()
+                labels = formatter.format_ticks(axis.get_majorticklocs())
+                key.append(tuple(len(label) for label in labels))
+                key.append(formatter.get_offset())
+        return key
+
+    def new_fig(self, **kwargs):
+        """
+        Create a figure drawn by the Agg backend (no pyplot state).
+        """
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(**kwargs)
+        FigureCanvasAgg(fig)
+        return fig
+
+    def layout(self, name):
+        """
+        Return the (figure, axes, lines) layout name, building it on the
+        first call.
+        """
+        if name not in self.layouts:
+            if name == 'base':
+                self.layouts[name] = self.base_layout()
+            elif name == 'daily':
+                self.layouts[name] = self.daily_layout()
+        return self.layouts[name]
+
+    def set_lines(self, axs, lines, x, ys, fmt=""):
+        """
+        Update the axes (axs) lines with x and the ys columns, new lines
+        are only created when the page has more columns than the previous
+        ones and the extra lines are hidden.
         """
-        Plot the base graph (15 in 15 minutes) from the selected documents.
+        while len(lines) < ys.shape[1]:
+            lines.extend(axs.plot(x, np.full(len(x), np.nan), fmt))
+        for i, line in enumerate(lines):
+            if i < ys.shape[1]:
+                line.set_data(x, ys[:, i])
+                line.set_visible(True)
+            else:
+                line.set_visible(False)
+        axs.relim(visible_only=True)
+        axs.autoscale_view()
+
+    def base_layout(self):
         """
-        fig = plt.figure(figsize=(7, 7), layout='constrained')
+        Build the base graph layout.
+        """
+        fig = self.new_fig(figsize=(7, 7), layout='constrained')
         axs = fig.subplot_mosaic([['ed', 'ed'],
                                   ["lu1", "lu2"],
                                   ["ld1", "ld2"],
                                   ["rss1", "rss2"]])
+        return fig, axs, {key: [] for key in axs}
 
-        for doc in docs:
-            for key, title, cols in base_graph_table:
-                self.plot_values(axs[key],
-                                 title + dts,
-                                 intp_arr,
-                                 [doc[k] for k in cols])
-                # save figure
-        self.save_fig(fig, 'spectroman/plots/' + dts)
+    def base_graph(self, dts, blocks):
+        """
+        Plot the base graph (15 in 15 minutes) from the bucket blocks.
+        """
+        self.render_base(dts, blocks, self.page_fname('base_graph', [dts]))
         pass
 
-    def daily_graph(self, date, docs):
+    def render_base(self, dts, blocks, fname):
         """
-        Plot the daily graph from the selected documents.
+        Render the base graph of a window, blocks are the
+        (n_samples, len(intp_arr)) spectra of each base_graph_table key.
         """
-        fig, axs = plt.subplots(6, 3, figsize=(40, 32))
-        axs = axs.flat
+        fig, axs, lines = self.layout('base')
+
+        for key, title, cols in base_graph_table:
+            # update all the window samples at once
+            axs[key].set_title(title + dts)
+            self.set_lines(axs[key], lines[key], intp_arr, blocks[key].T)
+        # save figure
+        self.save_fig(fig, fname)
+        pass
+
+    def daily_layout(self):
+        """
+        Build the daily graph layout.
+        """
+        import matplotlib.dates as pltdates
+        fig = self.new_fig(figsize=(40, 32))
+        axs = fig.subplots(6, 3).flat
         xfmt = pltdates.DateFormatter('%H:%M')
-        times = [doc['TIMESTAMP'] for doc in docs]
 
         for i, title in enumerate(day_plot_conf.keys()):
             top = day_plot_conf[title]['ylim'][1]
@@ -62,49 +159,60 @@ class Plot:
             if (top != None and bottom != None):
                 axs[i].set_ylim(top=top, bottom=bottom)
 
-            # set grid and x label format
+            # set title, grid and x label format
+            axs[i].set_title(title)
             axs[i].grid(color='gray', linestyle='--')
+            axs[i].xaxis_date()
             axs[i].xaxis.set_major_formatter(xfmt)
 
-            # plot values using the right columns
-            for col in day_plot_conf[title]['cols']:
-                self.plot_values(axs[i],
-                                 title,
-                                 times,
-                                 [d[col] for d in docs],
-                                 fmt='o-.')
-
         # adjust the subplots
-        plt.subplots_adjust(left=0.05,
+        fig.subplots_adjust(left=0.05,
                             bottom=0.05,
                             right=0.95,
                             top=0.9,
                             wspace=0.2,
                             hspace=0.2)
-
-        # parse date to string
-        date = date.strftime("%Y-%m-%d")
-        # adjust title
-        plt.suptitle(f'{date}', fontsize=50, y=0.96)
         # remove axs
         fig.delaxes(axs[16])
         fig.delaxes(axs[17])
+        return fig, axs, {i: [] for i in range(len(day_plot_conf))}
+
+    def daily_graph(self, date, docs):
+        """
+        Plot the daily graph from the selected documents.
+        """
+        import matplotlib.dates as pltdates
+        fig, axs, lines = self.layout('daily')
+        times = pltdates.date2num([doc['TIMESTAMP'] for doc in docs])
+
+        # plot values using the right columns
+        for i, title in enumerate(day_plot_conf.keys()):
+            self.set_lines(axs[i],
+                           lines[i],
+                           times,
+                           docs_to_arr(docs, day_plot_conf[title]['cols']),
+                           fmt='o-.')
+
+        # adjust title
+        fig.suptitle(date.strftime("%Y-%m-%d"), fontsize=50, y=0.96)
         # save figure
-        self.save_fig(fig, conf['PLOT_OUTPUT'] + 'daily_' + date)
+        self.save_fig(fig, self.page_fname('daily_graph', [date]))
         pass
 
     def monthly_css(self, beg, end, times, docs):
         """
         Plot the month graph (css) from the selected documents.
         """
-        fig, axs = plt.subplots(1, 1, figsize=(40, 32))
+        import matplotlib.dates as pltdates
+        # stems are not reusable artists, one figure per month
+        fig = self.new_fig(figsize=(40, 32))
+        axs = fig.subplots(1, 1)
         keys = monthly_graph_dict['keys']
         xfmt = pltdates.DateFormatter('%d/%m')
         axs.xaxis.set_major_formatter(xfmt)
         axs.grid(color='gray', linestyle='--')
         axs.set_ylim(top=2000)
-        plt.xticks(fontsize=30)
-        plt.yticks(fontsize=30)
+        axs.tick_params(labelsize=30)
         for key in keys[:1]:
             axs.stem(times,
                      [d[key] for d in docs],
@@ -115,15 +223,15 @@ class Plot:
 
         date = beg.strftime("%m/%Y")
         endl = '\n'
-        plt.suptitle(f'{date}{endl}sss mg/L', fontsize=50, y=0.96)
-        plt.subplots_adjust(left=0.05,
+        fig.suptitle(f'{date}{endl}sss mg/L', fontsize=50, y=0.96)
+        fig.subplots_adjust(left=0.05,
                             bottom=0.05,
                             right=0.95,
                             top=0.9,
                             wspace=0.2,
                             hspace=0.2)
         # save the figure
-        self.save_fig(fig, conf['PLOT_OUTPUT'] + 'sss_' + beg.strftime("%Y-%m"))
+        self.save_fig(fig, self.page_fname('monthly_css', [beg]))
         pass
 
     def plot_lst_values(self, lst, axs, title, dt):
@@ -133,44 +241,224 @@ class Plot:
         axs.set_title(title + dt)
         axs.plot(intp_arr, lst)
 
+    def windows(self, df, freq='15min'):
+        """
+        Split the data frame (df) in windows of freq (06:00 to 18:00),
+        yield the first TIMESTAMP of each non empty window and its
+        spectra blocks (key: (n_samples, len(intp_arr)) array views).
+        """
+        df = df.sort_values('TIMESTAMP')
+        ts = df['TIMESTAMP'].to_numpy(dtype='datetime64[ns]')
+        day = pd.Timestamp(ts[0]).strftime("%Y-%m-%d")
+        edges = pd.date_range(day + " 06:00:00",
+                              day + " 18:00:00",
+                              freq=freq,
+                              inclusive='both').values
+        # windows bounds, both edges included
+        beg = np.searchsorted(ts, edges[:-1], side='left')
+        end = np.searchsorted(ts, edges[1:], side='right')
+        # one contiguous copy of each spectra block, windows are views
+        arrs = {key: df[cols].to_numpy(dtype='float64')
+                for key, title, cols in base_graph_table}
+        for i, j in zip(beg, end):
+            if j > i:
+                yield ts[i], {key: arr[i:j] for key, arr in arrs.items()}
+
     def base_graph_from_df(self, df):
         """
         Plot base graph using the data frame (df) values.
         """
-        day = df['TIMESTAMP'].iloc[0].strftime("%Y-%m-%d")
-        beg = day + " 06:00:00"
-        end = day + " 18:00:00"
-        dts = pd.date_range(beg,
-                            end,
-                            freq='15T',
-                            inclusive='both').values
-        ts = []
-        for i in range(0, len(dts) - 1):
-            tmp = df.loc[(df['TIMESTAMP'] >= dts[i]) &
-                         (df['TIMESTAMP'] <= dts[i + 1])]['TIMESTAMP']
-            if not tmp.empty:
-                ts.append(tmp)
-
-        for t in ts:
-            beg = t.iloc[0]
-            end = t.iloc[-1]
-            fig = plt.figure(figsize=(7, 7),
-                             layout='constrained')
-
-            axs = fig.subplot_mosaic([['ed', 'ed'],
-                                      ["lu1", "lu2"],
-                                      ["ld1", "ld2"],
-                                      ["rss1", "rss2"]])
-
-            datetime = pd.to_datetime(str(beg)).strftime("%Y-%m-%d-%H-%M-%S")
-
-            for key, title, cols in plot_table:
-                df[(df['TIMESTAMP'] >= beg) &
-                   (df['TIMESTAMP'] <= end)][cols].\
-                   apply(self.plot_lst_values,
-                         args=(axs[key], title, datetime),
-                         raw=True,
-                         axis=1)
-                # save the figure
-            self.save_fig(fig, conf['PLOT_OUTPUT'] + datetime)
-            pass
+        for ts, blocks in self.windows(df):
+            datetime = pd.Timestamp(ts).strftime("%Y-%m-%d-%H-%M-%S")
+            self.submit('render_base',
+                        datetime,
+                        blocks,
+                        conf['PLOT_OUTPUT'] + datetime)
+        pass
+
+    def page_fname(self, method, args):
+        """
+        Return the output file name (no extension) of the page rendered
+        by method with args.
+        """
+        if method == 'base_graph':
+            return 'spectroman/plots/' + args[0]
+        if method == 'render_base':
+            return args[2]
+        if method == 'daily_graph':
+            return (conf['PLOT_OUTPUT'] + 'daily_' +
+                    args[0].strftime("%Y-%m-%d"))
+        if method == 'monthly_css':
+            return conf['PLOT_OUTPUT'] + 'sss_' + args[0].strftime("%Y-%m")
+
+    def page_key(self, method, args):
+        """
+        Return the hash of the exact page input: the method, its args
+        (timestamps and values) and the plot configuration.
+        """
+        h = hashlib.sha1()
+        digest(h, [method, args, self.dpi, self.fmt,
+                   base_graph_table, day_plot_conf, monthly_graph_dict])
+        return h.hexdigest()
+
+    def submit(self, method, *args):
+        """
+        Render a page with the method (name), inline or on the pool of
+        workers processes when workers > 1. The page is skipped if its
+        file is up to date with the cache.
+        """
+        fname = self.page_fname(method, args)
+        key = self.page_key(method, args)
+        if self.cache.fresh(fname, key, f'{fname}.{self.fmt}'):
+            self.skipped += 1
+            return
+        if self.workers <= 1:
+            with metrics.timer('plot_render'):
+                getattr(self, method)(*args)
+            self.cache.set(fname, key)
+            return
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                            initializer=init_worker,
+                                            initargs=(self.dpi, self.fmt))
+        # bound the pages in flight (and their data) in memory
+        if len(self.pending) >= 4 * self.workers:
+            done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+            self.collect(done)
+        self.pending[self.pool.submit(render_page, method, args)] = (fname,
+                                                                     key)
+
+    def collect(self, futures):
+        """
+        Cache the rendered pages of the futures, log the failed ones.
+        """
+        for future in futures:
+            fname, key = self.pending.pop(future)
+            try:
+                seconds = future.result()
+            except Exception as e:
+                log.info(f"Exception {e}")
+            else:
+                metrics.observe('plot_render', seconds)
+                self.cache.set(fname, key)
+
+    def join(self):
+        """
+        Wait for the submitted pages, stop the workers and save the cache.
+        """
+        if self.pool is not None:
+            done, _ = wait(self.pending)
+            self.collect(done)
+            self.pool.shutdown()
+            self.pool = None
+        if self.skipped:
+            log.info(f'{self.skipped} pages up to date, skipped')
+            self.skipped = 0
+        self.cache.save()
+        pass
+
+class PlotCache:
+    """
+    Content-addressed pages cache, a JSON index (file name: input hash)
+    of the rendered pages. A page is rendered again only if its input
+    hash changed, its file is missing or it was invalidated. The cache
+    is disabled if fname is None.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.index = None
+
+    def load(self):
+        """
+        Return the index, loading it on the first call.
+        """
+        if self.index is None:
+            self.index = {}
+            if self.fname and os.path.exists(self.fname):
+                with open(self.fname) as f:
+                    self.index = json.load(f)
+        return self.index
+
+    def save(self):
+        """
+        Save the index (atomically).
+        """
+        if self.fname is None or self.index is None:
+            return
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.fname)
+
+    def fresh(self, page, key, path):
+        """
+        Return True if the page file (path) was rendered from key.
+        """
+        if self.fname is None:
+            return False
+        return self.load().get(page) == key and os.path.exists(path)
+
+    def set(self, page, key):
+        """
+        Record the page rendered from key.
+        """
+        if self.fname is not None:
+            self.load()[page] = key
+
+    def invalidate(self, dates=None):
+        """
+        Drop the pages of the dates (all of them if dates is None), they
+        are rendered again on the next run.
+        """
+        if self.fname is None:
+            return
+        if dates is None:
+            self.index = {}
+        else:
+            tags = set()
+            for d in dates:
+                tags.add(d.strftime("%Y-%m-%d"))
+                tags.add('sss_' + d.strftime("%Y-%m"))
+            self.index = {k: v for k, v in self.load().items()
+                          if not any(t in os.path.basename(k) for t in tags)}
+        self.save()
+
+def digest(h, obj):
+    """
+    Update the hash (h) with the obj content (arrays, dicts, lists and
+    scalars by their repr).
+    """
+    if isinstance(obj, np.ndarray):
+        h.update(repr((obj.dtype.str, obj.shape)).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        h.update(b'{')
+        for k in sorted(obj, key=str):
+            digest(h, k)
+            digest(h, obj[k])
+        h.update(b'}')
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'[')
+        for v in obj:
+            digest(h, v)
+        h.update(b']')
+    else:
+        h.update(repr(obj).encode())
+
+# the workers processes renderer, its layouts live with the process
+renderer = None
+
+def init_worker(dpi, fmt):
+    """
+    Process pool initializer, create the process renderer.
+    """
+    global renderer
+    renderer = Plot(dpi, fmt, workers=1)
+
+def render_page(method, args):
+    """
+    Process pool entry point, see Plot.submit. Return the render time.
+    """
+    beg = time.perf_counter()
+    getattr(renderer, method)(*args)
+    return time.perf_counter() - beg
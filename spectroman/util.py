@@ -1,13 +1,15 @@
 # builtin library
+import queue
 import calendar
-from os import listdir, rename
+import hashlib
+import threading
+from os import listdir, rename, stat
 from os.path import isfile, join, abspath, basename, curdir
 from io import StringIO
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, time, timedelta
 
 # 3rd party libraries
 import numpy as np
-from scipy.interpolate import griddata
 
 # internal modules
 from spectroman.conf import conf
@@ -41,6 +43,23 @@ def file_to_str_io(fname):
     with open(fname) as f:
         return StringIO(f.read())
 
+def file_hash(fname, size=1 << 20):
+    """
+    Return the sha1 hex digest of the file content.
+    """
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def file_entry(fname):
+    """
+    Return the file ledger entry: path, size and modification time.
+    """
+    st = stat(fname)
+    return {'path': fname, 'size': st.st_size, 'mtime': st.st_mtime}
+
 def list_date():
     """
     Return a list of csv file name dates.
@@ -80,6 +99,15 @@ def get_intp_selection():
         dict[c] = 1
     return dict
 
+def get_calib_selection():
+    """
+    Get the CalibData columns selection (mongodb related).
+    """
+    dict = {'_id': 1}
+    for c in calib_columns:
+        dict[c] = 1
+    return dict
+
 def get_daily_selection():
     """
     Get columns selection for the daily graph.
@@ -92,9 +120,9 @@ def get_daily_selection():
 
 def get_css_selection():
     """
-    Get css selection for the
+    Get css selection for the monthly graph.
     """
-    cols = [c for c in daily_graph_dict['Sss']]
+    cols = [c for c in monthly_graph_dict['keys']]
     dict = {'_id': 0, 'TIMESTAMP':1}
     for c in cols:
         dict[c] = 1
@@ -123,6 +151,73 @@ def fieldstr_filter(columns):
     filter = [{c: {"$type": 2}} for c in cols]
     return { "$or": filter}
 
+def hours_filter(beg, end):
+    """
+    Create a filter of the documents with TIMESTAMP time between beg:00
+    and end:00, both included (see in_hours).
+    """
+    ts = '$TIMESTAMP'
+    hour = {'$hour': ts}
+    return {'$expr': {'$or': [{'$and': [{'$gte': [hour, beg]},
+                                        {'$lt': [hour, end]}]},
+                              {'$and': [{'$eq': [hour, end]},
+                                        {'$eq': [{'$minute': ts}, 0]},
+                                        {'$eq': [{'$second': ts}, 0]},
+                                        {'$eq': [{'$millisecond': ts}, 0]}]}]}}
+
+def in_hours(ts, beg, end):
+    """
+    Return True if the ts time is between beg:00 and end:00, both
+    included (see hours_filter).
+    """
+    return time(beg) <= ts.time() <= time(end)
+
+def same_value(a, b):
+    """
+    Return True if the values are equal (NaN values are equal too).
+    """
+    return a == b or (a != a and b != b)
+
+def chunks(iterable, size):
+    """
+    Split the iterable in lists of (at most) size elements.
+    """
+    chunk = []
+    for i in iterable:
+        chunk.append(i)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def prefetch(iterable, size=2):
+    """
+    Iterate the iterable in a background thread, up to size items
+    ahead of the consumer. The producer exceptions are raised by the
+    consumer.
+    """
+    items = queue.Queue(maxsize=size)
+    end = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+        finally:
+            items.put(end)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is end:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
 def daterange(start_date, end_date):
     """
     Create a data range.
@@ -134,3 +229,19 @@ def get_dates(start, end):
     "Return dates (datetimes) list."
     return [d for d in daterange(datetime.strptime(start, "%Y-%m-%d"),
                                  datetime.strptime(end, "%Y-%m-%d"))]
+
+def get_range(start, end, required=True):
+    """
+    Return the (start, end) datetimes of the dates in the format
+    year-month-day, None if not set (only if not required). Raise
+    ValueError if a required date is missing or the range is empty.
+    """
+    if required and not (start and end):
+        raise ValueError('the start and end dates (year-month-day) are '
+                         'required')
+    start, end = [datetime.strptime(d, "%Y-%m-%d") if d else None
+                  for d in (start, end)]
+    if start and end and start >= end:
+        raise ValueError(f'empty range, the end ({end:%Y-%m-%d}) must be '
+                         f'after the start ({start:%Y-%m-%d})')
+    return start, end
@@ -0,0 +1,104 @@
+import json
+import time
+import signal
+import asyncio
+from datetime import datetime
+
+from spectroman.log import log
+from spectroman.conf import conf
+from spectroman.metrics import metrics
+from spectroman.util import list_csvs
+from spectroman.core import Spectroman
+
+class Watch:
+    """
+    Long-running ingestion daemon: every interval the new files from the
+    FTP host (or a local drop folder) go through the fused pipeline,
+    the same Spectroman instance (database and FTP connections,
+    interpolation operators) is reused by all the cycles.
+    """
+    def __init__(self, interval=None, folder=None, heartbeat=None):
+        self.s = Spectroman()
+        self.interval = interval or conf['WATCH_INTERVAL']
+        self.folder = folder
+        self.heartbeat = heartbeat or conf['WATCH_HEARTBEAT']
+        self.stop = None
+        self.cycles = 0
+
+    def cycle(self):
+        """
+        Fetch (or list) the new files and ingest them, return the number
+        of files ingested.
+        """
+        if self.folder:
+            # the files already ingested are skipped by the ledger
+            files = list_csvs(self.folder)
+        else:
+            if self.s.ftp.ftp is None:
+                self.s.ftp.connect()
+            else:
+                self.s.ftp.ping()
+            files = self.s.ftp.sync(keep=True)
+        return self.s.ingest_files(files)
+
+    def beat(self, files, duration, error=None):
+        """
+        Write the heartbeat file: last cycle time and duration, files
+        and the lag (seconds) between now and the newest document.
+        """
+        now = datetime.now()
+        last = self.s.db.last_timestamp(conf['DB_COLL_DF'])
+        lag = (now - last).total_seconds() if last else None
+        beat = {'time': now.isoformat(),
+                'cycle': self.cycles,
+                'files': files,
+                'duration': duration,
+                'last': last.isoformat() if last else None,
+                'lag': lag,
+                'error': error}
+        with open(self.heartbeat, 'w') as f:
+            json.dump(beat, f)
+        log.info(f'Cycle {self.cycles}: {files} files in {duration:.1f}s, '
+                 f'lag: {lag}s')
+
+    async def run(self):
+        """
+        Run the cycles until SIGTERM (or SIGINT) is received, the
+        current cycle is always finished before leaving.
+        """
+        loop = asyncio.get_running_loop()
+        self.stop = asyncio.Event()
+        for sig in [signal.SIGTERM, signal.SIGINT]:
+            loop.add_signal_handler(sig, self.stop.set)
+        self.s.db.ensure_indexes()
+        log.info(f'Watching {self.folder or self.s.ftp.host} '
+                 f'every {self.interval}s...')
+        while not self.stop.is_set():
+            beg = time.monotonic()
+            files = 0
+            error = None
+            self.cycles += 1
+            try:
+                files = await loop.run_in_executor(None, self.cycle)
+            except Exception as e:
+                error = repr(e)
+                log.info(f'Exception {e}')
+            try:
+                self.beat(files, time.monotonic() - beg, error)
+                metrics.export()
+            except Exception as e:
+                log.info(f'Exception {e}')
+            try:
+                await asyncio.wait_for(self.stop.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+        log.info('Stopping...')
+        self.s.ftp.close()
+        self.s.db.close()
+        pass
+
+def watch(interval=None, folder=None):
+    """
+    Run the watch daemon.
+    """
+    asyncio.run(Watch(interval, folder).run())
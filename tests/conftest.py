@@ -0,0 +1,71 @@
+"""
+Test settings: the settings without default (see spectroman.conf) are
+set to a temporary folder and a local database before the spectroman
+modules are imported.
+"""
+import os
+import tempfile
+
+tmp = tempfile.mkdtemp(prefix='spectroman_tests_')
+
+for key, value in {'FTP_HOST': '127.0.0.1',
+                   'FTP_USER': 'spectroman',
+                   'FTP_PASS': 'spectroman',
+                   'FTP_PATH': '/',
+                   'FTP_TODO': os.path.join(tmp, 'todo'),
+                   'FTP_DONE': os.path.join(tmp, 'done'),
+                   'FTP_FAIL': os.path.join(tmp, 'fail'),
+                   'DB_URI': 'mongodb://localhost:27017',
+                   'DB_NAME': 'spectroman_tests',
+                   'DB_COLL_DF': 'df',
+                   'DB_COLL_RAW': 'raw',
+                   'DB_COLL_MAIN': 'main',
+                   'DB_ATLAS_URI': 'mongodb://localhost:27017',
+                   'DB_ATLAS_NAME': 'spectroman_tests',
+                   'DB_ATLAS_COLL': 'atlas',
+                   'PLOT_OUTPUT': os.path.join(tmp, 'plots') + os.sep,
+                   'LOG_OUTPUT': tmp,
+                   'DATA_OUTPUT': os.path.join(tmp, 'output'),
+                   'DATA_BACKUP': os.path.join(tmp, 'backup')}.items():
+    os.environ.setdefault(key, value)
+
+for key in ['FTP_TODO', 'FTP_DONE', 'FTP_FAIL', 'PLOT_OUTPUT',
+            'DATA_OUTPUT', 'DATA_BACKUP']:
+    os.makedirs(os.environ[key], exist_ok=True)
+
+import numpy as np
+import pandas as pd
+import pytest
+
+@pytest.fixture
+def spectroman(monkeypatch):
+    """
+    Spectroman over an in-process database (needs mongomock).
+    """
+    mongomock = pytest.importorskip('mongomock')
+    import pymongo
+    monkeypatch.setattr(pymongo, 'MongoClient', mongomock.MongoClient)
+    from spectroman.core import Spectroman
+    s = Spectroman()
+    yield s
+    s.db.connect()
+    s.db.client.drop_database(s.db.name)
+    s.db.close()
+
+@pytest.fixture
+def calib_docs():
+    """
+    Return a function building n cleaned documents (one per minute from
+    start) with random CalibData values.
+    """
+    from spectroman.const import calib_columns, STAGE_CLEANED
+
+    def build(n, start='2024-01-01 06:00:00', seed=0):
+        rng = np.random.default_rng(seed)
+        values = rng.random((n, len(calib_columns))) + 0.5
+        times = pd.date_range(start, periods=n, freq='min')
+        return [dict(zip(calib_columns, row.tolist()),
+                     TIMESTAMP=ts.to_pydatetime(),
+                     STAGE=STAGE_CLEANED)
+                for ts, row in zip(times, values)]
+    return build
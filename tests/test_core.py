@@ -0,0 +1,165 @@
+from spectroman.conf import conf
+from spectroman.const import STAGE_CLEANED, STAGE_CSS
+
+def test_process_intp_drops_only_malformed_docs(spectroman, calib_docs):
+    docs = calib_docs(5)
+    docs[2]['CalibData_c1(5)'] = 'not a number'
+    coll = spectroman.db.get_coll_df()
+    coll.insert_many(docs)
+    spectroman.process_intp(chunk_size=5)
+    stages = {d['TIMESTAMP']: d['STAGE'] for d in coll.find()}
+    assert stages.pop(docs[2]['TIMESTAMP']) == STAGE_CLEANED
+    assert set(stages.values()) == {STAGE_CSS}
+    assert coll.count_documents({'rss1_650': {'$exists': True}}) == 4
+
+def test_process_files_moves_days_done_before_interrupt(spectroman,
+                                                        tmp_path,
+                                                        monkeypatch):
+    import pytest
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'files').mkdir()
+    files = []
+    for day in ['20240101', '20240102']:
+        files.append(tmp_path / f'{day}_spectroman.csv')
+        files[-1].write_text('')
+
+    def process_day(day, files):
+        if day == '20240102':
+            raise KeyboardInterrupt
+        return {'day': day, 'files': files, 'rows': 1, 'error': None}
+    monkeypatch.setattr(spectroman, 'process_day', process_day)
+
+    with pytest.raises(KeyboardInterrupt):
+        spectroman.process_files([str(f) for f in files])
+    assert (tmp_path / 'files' / files[0].name).exists()
+    assert files[1].exists()
+
+def test_process_files_keeps_the_days_with_files_not_parsed(spectroman,
+                                                            tmp_path,
+                                                            monkeypatch):
+    from datetime import datetime
+    from benchmarks.gen import write_csv
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'files').mkdir()
+    good = write_csv(str(tmp_path / '20240101_spectroman.csv'),
+                     datetime(2024, 1, 1, 6), 3, junk=0)
+    bad = tmp_path / '20240102_spectroman.csv'
+    bad.write_bytes(b'\xff\xfe\x00not a csv')
+    spectroman.process_files([good, str(bad)])
+    assert (tmp_path / 'files' / '20240101_spectroman.csv').exists()
+    assert bad.exists()
+
+def test_clean_docs_tags_raw_docs_by_outcome(spectroman, calib_docs):
+    from spectroman.const import STAGE_RAW, STAGE_SKIPPED
+    docs = calib_docs(4)
+    for doc in docs:
+        doc['TIMESTAMP'] = doc['TIMESTAMP'].strftime('%Y-%m-%d %H:%M:%S')
+        doc['STAGE'] = STAGE_RAW
+    docs[1]['CalibData_c1(1)'] = float('nan')
+    docs[2]['TIMESTAMP'] = 'not a date'
+    spectroman.db.get_coll_raw().insert_many(docs)
+    # the copy of the last document fails (duplicate _id)
+    spectroman.db.get_coll_df().insert_one({'_id': docs[3]['_id']})
+    spectroman.clean_docs()
+    stages = [d['STAGE'] for d in
+              spectroman.db.get_coll_raw().find().sort('_id', 1)]
+    assert stages == [STAGE_CLEANED, STAGE_SKIPPED, STAGE_RAW, STAGE_RAW]
+    df = spectroman.db.get_coll_df()
+    assert df.count_documents({'STAGE': STAGE_CLEANED}) == 1
+
+def test_ingest_files_retries_files_not_parsed(spectroman, tmp_path):
+    from datetime import datetime
+    from benchmarks.gen import write_csv
+    good = write_csv(str(tmp_path / 'good.csv'), datetime(2024, 1, 1, 6), 5)
+    bad = str(tmp_path / 'bad.csv')
+    with open(bad, 'wb') as f:
+        f.write(b'\xff\xfe\x00not a csv')
+    assert spectroman.ingest_files([good, bad]) == 2
+    entries = spectroman.db.fetch_ledger(conf['DB_COLL_DF'])
+    assert entries[good]['status'] == 'done'
+    assert entries[bad]['status'] == 'failed'
+    assert 'error' in entries[bad]
+    # only the failed file is ingested again
+    assert spectroman.ingest_files([good, bad]) == 1
+
+def test_basic_buckets_include_docs_without_stage(spectroman, tmp_path):
+    from datetime import datetime
+    from benchmarks.gen import write_csv
+    from spectroman.data import csv_to_df
+    fname = write_csv(str(tmp_path / 'day.csv'), datetime(2024, 1, 1, 6), 30,
+                      junk=0)
+    docs = spectroman.ingest_df(csv_to_df(fname))
+    for doc in docs[:15]:
+        del doc['STAGE']
+    spectroman.db.get_coll_df().insert_many(docs)
+    buckets = list(spectroman.basic_buckets(datetime(2024, 1, 1),
+                                            datetime(2024, 1, 2)))
+    assert [ts.minute for ts, _ in buckets] == [0, 15]
+    assert [len(blocks['ed']) for _, blocks in buckets] == [15, 15]
+
+def test_basic_buckets_close_with_the_18h_sample(spectroman, tmp_path):
+    from datetime import datetime
+    from benchmarks.gen import write_csv
+    from spectroman.data import csv_to_df
+    fname = write_csv(str(tmp_path / 'day.csv'), datetime(2024, 1, 1, 17, 40),
+                      30, junk=0)
+    spectroman.db.get_coll_df().insert_many(
+        spectroman.ingest_df(csv_to_df(fname)))
+    buckets = list(spectroman.basic_buckets(datetime(2024, 1, 1),
+                                            datetime(2024, 1, 2)))
+    # 17:40 to 17:44, 17:45 to 18:00 (included), not after 18:00
+    assert [(ts.hour, ts.minute) for ts, _ in buckets] == [(17, 30), (17, 45)]
+    assert [len(blocks['ed']) for _, blocks in buckets] == [5, 16]
+
+def test_products_without_css_keep_the_interpolated_stage(spectroman,
+                                                          calib_docs):
+    from datetime import datetime
+    from spectroman.const import STAGE_INTP
+    from spectroman.model import product_bands
+    from spectroman.const import intp_arr
+    docs = calib_docs(3)
+    coll = spectroman.db.get_coll_df()
+    coll.insert_many(docs)
+    spectroman.db.set_watermark(STAGE_CSS, datetime(2023, 1, 1))
+    spectroman.bands = product_bands(['chla'], intp_arr)
+    spectroman.process_intp()
+    assert {d['STAGE'] for d in coll.find()} == {STAGE_INTP}
+    assert spectroman.db.get_watermark(STAGE_CSS) == datetime(2023, 1, 1)
+    assert coll.count_documents({'css1': {'$exists': True}}) == 0
+    # the css product is computed by the next (incremental) run
+    spectroman.bands = product_bands(['css', 'chla'], intp_arr)
+    spectroman.process_css()
+    assert {d['STAGE'] for d in coll.find()} == {STAGE_CSS}
+    assert coll.count_documents({'css1': {'$exists': True}}) == 3
+    assert spectroman.db.get_watermark(STAGE_CSS) == docs[-1]['TIMESTAMP']
+
+def test_float32_mode_keeps_the_raw_calib_values(spectroman, tmp_path):
+    from datetime import datetime
+    import numpy as np
+    from benchmarks.gen import write_csv
+    from spectroman.const import calib_columns
+    from spectroman.data import csv_to_df, process_df, convert_strs
+    fname = write_csv(str(tmp_path / 'day.csv'), datetime(2024, 1, 1, 6), 3,
+                      junk=0)
+    df = convert_strs(process_df(csv_to_df(fname)), calib_columns)
+    spectroman.dtype = 'float32'
+    docs = spectroman.ingest_df(csv_to_df(fname))
+    assert [d[c] for d in docs for c in calib_columns] ==\
+        df[calib_columns].to_numpy().ravel().tolist()
+    # the derived spectra are computed in float32
+    assert all(d['ed_650'] == np.float32(d['ed_650']) for d in docs)
+
+def test_init_stages_cleans_only_the_copied_raw_docs(spectroman, calib_docs):
+    from spectroman.const import STAGE_RAW
+    docs = calib_docs(3)
+    for doc in docs:
+        del doc['STAGE']
+    spectroman.db.get_coll_raw().insert_many(docs)
+    # only the first document was copied (same _id) by the old pipeline
+    spectroman.db.get_coll_df().insert_one(dict(docs[0]))
+    spectroman.init_stages()
+    stages = [d['STAGE'] for d in
+              spectroman.db.get_coll_raw().find().sort('_id', 1)]
+    assert stages == [STAGE_CLEANED, STAGE_RAW, STAGE_RAW]
+    assert [d['STAGE'] for d in spectroman.db.get_coll_df().find()] ==\
+        [STAGE_CLEANED]
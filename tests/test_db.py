@@ -0,0 +1,75 @@
+from datetime import datetime
+
+from spectroman.conf import conf
+
+def test_ensure_indexes_reports_duplicated_timestamps(spectroman):
+    ts = datetime(2024, 1, 1, 6)
+    spectroman.db.get_coll_df().insert_many([{'TIMESTAMP': ts},
+                                             {'TIMESTAMP': ts}])
+    failed = spectroman.db.ensure_indexes()
+    assert [(coll, keys) for coll, keys, _ in failed] ==\
+        [(conf['DB_COLL_DF'], [('TIMESTAMP', 1)])]
+    assert spectroman.db.duplicate_timestamps(conf['DB_COLL_DF']) == [ts]
+
+def test_ensure_indexes(spectroman):
+    from spectroman.db import AXIS
+    assert spectroman.db.ensure_indexes() == []
+    assert spectroman.db.get_coll_main().find_one({'_id': AXIS}) is None
+    # the packed documents refer to the axis descriptor
+    spectroman.db.schema = 'packed'
+    assert spectroman.db.ensure_indexes() == []
+    axis = spectroman.db.get_coll_main().find_one({'_id': AXIS})
+    assert len(axis['rss1']) == 531
+
+def test_ledger_failed_flush_marks_only_buffered_files(spectroman, tmp_path):
+    from spectroman.db import Ledger
+    files = []
+    for name in ['a.csv', 'b.csv']:
+        files.append(str(tmp_path / name))
+        (tmp_path / name).write_text(name)
+    ledger = Ledger(spectroman.db, conf['DB_COLL_DF'])
+    entry = ledger.check(files[0])
+    ledger.track(False)
+    ledger.add(entry)
+    ledger.commit(True)
+    entry = ledger.check(files[1])
+    ledger.add(entry)
+    ledger.commit(True)
+    assert [ledger.entries[f]['status'] for f in files] == ['failed', 'done']
+
+def test_pool_listener_handles_every_pool_event():
+    from pymongo import monitoring
+    from spectroman.db import PoolListener
+    listener = PoolListener()
+    for name in dir(monitoring.ConnectionPoolListener):
+        if name.startswith(('pool_', 'connection_')):
+            getattr(listener, name)(None)
+    assert (listener.opened, listener.closed) == (1, 1)
+
+def test_command_listener_records_round_trips():
+    from types import SimpleNamespace
+    from spectroman.db import CommandListener
+    from spectroman.metrics import metrics
+    metrics.enabled = True
+    try:
+        event = SimpleNamespace(command_name='find', duration_micros=1000)
+        CommandListener().succeeded(event)
+        CommandListener().failed(event)
+        snapshot = metrics.snapshot()
+    finally:
+        metrics.enabled = False
+    assert snapshot['counters']['db_round_trips'] >= 2
+    assert snapshot['timers']['db_cmd_find']['count'] >= 2
+
+def test_command_listener_records_the_reads_latency(spectroman):
+    from types import SimpleNamespace
+    from spectroman.db import CommandListener
+    listener = CommandListener(spectroman.db)
+    for name, micros in [('find', 2000), ('getMore', 3000),
+                         ('getMore', 1000), ('insert', 1000)]:
+        listener.succeeded(SimpleNamespace(command_name=name,
+                                           duration_micros=micros))
+    ops = spectroman.db.stats()['ops']
+    assert ops['find']['count'] == 1
+    assert (ops['getMore']['count'], ops['getMore']['total']) == (2, 0.004)
+    assert 'insert' not in ops
@@ -0,0 +1,125 @@
+import os
+import json
+import threading
+
+import pytest
+
+from spectroman.ftp import Ftp
+
+@pytest.fixture
+def server(tmp_path):
+    """
+    Local FTP server (needs pyftpdlib), return its root folder and port.
+    """
+    pytest.importorskip('pyftpdlib')
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    root = tmp_path / 'remote'
+    root.mkdir()
+    authorizer = DummyAuthorizer()
+    authorizer.add_user('spectroman', 'spectroman', str(root), perm='elr')
+    handler = type('Handler', (FTPHandler,), {'authorizer': authorizer})
+    ftpd = ThreadedFTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=ftpd.serve_forever,
+                              kwargs={'timeout': 0.1},
+                              daemon=True)
+    thread.start()
+    yield root, ftpd.address[1]
+    ftpd.close_all()
+    thread.join()
+
+@pytest.fixture
+def ftp(server, tmp_path):
+    root, port = server
+    (tmp_path / 'local').mkdir()
+    ftp = Ftp(host='127.0.0.1', port=port, path='/',
+              user='spectroman', passwd='spectroman', workers=2,
+              output=str(tmp_path / 'local'),
+              manifest=str(tmp_path / 'manifest.json'))
+    ftp.connect()
+    yield ftp
+    ftp.close()
+    ftp.ftp.quit()
+
+def write(path, data, mtime):
+    path.write_bytes(data)
+    os.utime(path, (mtime, mtime))
+
+def test_sync_downloads_new_and_changed_files(server, ftp, tmp_path):
+    root, _ = server
+    write(root / 'a.csv', b'a' * 100, 1700000000)
+    write(root / 'b.csv', b'b' * 200, 1700000000)
+    saved = ftp.sync(keep=True)
+    assert sorted(os.path.basename(f) for f in saved) == ['a.csv', 'b.csv']
+    assert (tmp_path / 'local' / 'b.csv').read_bytes() == b'b' * 200
+    manifest = json.loads((tmp_path / 'manifest.json').read_text())
+    assert manifest['a.csv']['size'] == 100
+    # nothing changed
+    assert ftp.sync(keep=True) == []
+    # only the changed file is downloaded again
+    write(root / 'b.csv', b'c' * 200, 1700000100)
+    saved = ftp.sync(keep=True)
+    assert [os.path.basename(f) for f in saved] == ['b.csv']
+    assert (tmp_path / 'local' / 'b.csv').read_bytes() == b'c' * 200
+
+def test_download_resumes_the_same_version(server, ftp, tmp_path):
+    root, _ = server
+    write(root / 'a.csv', b'a' * 1000, 1700000000)
+    entry = ftp.files_entries()['a.csv']
+    partial = tmp_path / 'local' / '.partial'
+    partial.mkdir()
+    part = partial / 'a.csv.part'
+    part.write_bytes(b'x' * 400)
+    (partial / 'a.csv.part.json').write_text(json.dumps(entry))
+    ftp.sync(keep=True)
+    # the partial bytes are kept, only the rest is transferred
+    assert (tmp_path / 'local' / 'a.csv').read_bytes() ==\
+        b'x' * 400 + b'a' * 600
+    assert not part.exists()
+    assert not (partial / 'a.csv.part.json').exists()
+
+def test_download_restarts_a_changed_version(server, ftp, tmp_path):
+    root, _ = server
+    write(root / 'a.csv', b'a' * 1000, 1700000000)
+    entry = ftp.files_entries()['a.csv']
+    # a stale partial download of the previous version, same size
+    partial = tmp_path / 'local' / '.partial'
+    partial.mkdir()
+    (partial / 'a.csv.part').write_bytes(b'x' * 1000)
+    (partial / 'a.csv.part.json').write_text(
+        json.dumps(dict(entry, modify='20000101000000')))
+    ftp.sync(keep=True)
+    assert (tmp_path / 'local' / 'a.csv').read_bytes() == b'a' * 1000
+
+def test_list_csvs_skips_an_interrupted_sync(server, ftp, tmp_path,
+                                            monkeypatch):
+    import ftplib
+    from spectroman.util import list_csvs
+    root, _ = server
+    write(root / 'a.csv', b'a' * 100, 1700000000)
+    write(root / 'b.csv', b'b' * 100000, 1700000000)
+    retrbinary = ftplib.FTP.retrbinary
+
+    def broken(self, cmd, callback, *args, **kwargs):
+        # the b.csv transfer is lost after its first block
+        def first(data):
+            callback(data)
+            if cmd.endswith('b.csv'):
+                raise ConnectionError('connection lost')
+        return retrbinary(self, cmd, first, *args, **kwargs)
+
+    monkeypatch.setattr(ftplib.FTP, 'retrbinary', broken)
+    saved = ftp.sync(keep=True)
+    assert [os.path.basename(f) for f in saved] == ['a.csv']
+    local = tmp_path / 'local'
+    assert sorted(os.listdir(local / '.partial')) ==\
+        ['b.csv.part', 'b.csv.part.json']
+    assert list_csvs(str(local)) == [str(local / 'a.csv')]
+    # the next sync resumes it
+    monkeypatch.setattr(ftplib.FTP, 'retrbinary', retrbinary)
+    assert [os.path.basename(f) for f in ftp.sync(keep=True)] == ['b.csv']
+    assert (local / 'b.csv').read_bytes() == b'b' * 100000
+    assert os.listdir(local / '.partial') == []
+    assert sorted(list_csvs(str(local))) ==\
+        [str(local / 'a.csv'), str(local / 'b.csv')]
@@ -0,0 +1,60 @@
+import numpy as np
+from scipy.interpolate import griddata
+
+from spectroman import const
+from spectroman.const import intp_arr
+from spectroman.model import linear_intp, linear_intp_op, linear_intp_arr
+
+def test_intp_op_matches_griddata():
+    rng = np.random.default_rng(0)
+    for _, _, wl in const.intp_table:
+        arr = rng.random((20, len(wl)))
+        op = linear_intp_op(wl, intp_arr)
+        expected = np.array([griddata(wl, row, intp_arr, method='linear')
+                             for row in arr])
+        np.testing.assert_allclose(linear_intp_arr(arr, op), expected,
+                                   rtol=1e-12, atol=1e-12)
+
+def test_intp_op_unsorted_and_out_of_range():
+    wl = np.array([700.0, 400.0, 550.0, 900.0])
+    row = np.array([3.0, 1.0, 2.0, 4.0])
+    op = linear_intp_op(wl, intp_arr)
+    out = linear_intp_arr(row[None, :], op)[0]
+    np.testing.assert_array_equal(np.isnan(out), intp_arr > 900)
+    np.testing.assert_allclose(out, linear_intp(row, wl, intp_arr))
+
+def test_wl_dat_cache_replaces_old_versions(tmp_path, monkeypatch):
+    import shutil
+    from spectroman import data
+    src = data.join(data.wl_dat_path, 'wl8711_01600011.dat')
+    shutil.copy(src, tmp_path / 'wl.dat')
+    monkeypatch.setattr(data, 'wl_dat_path', str(tmp_path))
+    expected = data.get_wl_dat('wl.dat')
+    (tmp_path / 'wl.dat.000000000000.npy').write_bytes(b'stale')
+    # parsed again when the table changes, the old caches are removed
+    with open(tmp_path / 'wl.dat', 'a') as f:
+        f.write('\n')
+    np.testing.assert_array_equal(data.get_wl_dat('wl.dat'), expected)
+    assert len(list(tmp_path.glob('wl.dat.*.npy'))) == 1
+    # and loaded from the cache
+    np.testing.assert_array_equal(data.get_wl_dat('wl.dat'), expected)
+
+def test_calc_products_matches_the_scalar_models():
+    import pytest
+    from spectroman.model import (products_table, product_bands,
+                                  calc_products, find_nearest)
+    rng = np.random.default_rng(0)
+    rss = [0.05 * rng.random((50, len(intp_arr))) for _ in range(2)]
+    bands = product_bands(list(products_table), intp_arr)
+    values = calc_products(rss, bands)
+    with np.errstate(all='ignore'):
+        for name, (model, wavelengths) in products_table.items():
+            for k, r in enumerate(rss, 1):
+                expected = np.array([
+                    model(*[row[find_nearest(intp_arr, w)]
+                            for w in wavelengths]) for row in r],
+                    dtype='float64')
+                np.testing.assert_allclose(values[f'{name}{k}'], expected,
+                                           equal_nan=True)
+    with pytest.raises(ValueError, match='foo'):
+        product_bands(['css', 'foo'], intp_arr)
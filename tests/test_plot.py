@@ -0,0 +1,51 @@
+import numpy as np
+
+from spectroman.const import base_graph_table, intp_arr
+from spectroman.plot import Plot
+
+def blocks(scale, seed=0):
+    rng = np.random.default_rng(seed)
+    return {key: scale * rng.random((3, len(intp_arr)))
+            for key, title, cols in base_graph_table}
+
+def inside(fig):
+    """
+    Return True if every axes (with its titles and ticks labels) is
+    drawn inside the figure.
+    """
+    renderer = fig.canvas.get_renderer()
+    return all(fig.bbox.x0 - 1 <= bb.x0 and bb.x1 <= fig.bbox.x1 + 1 and
+               fig.bbox.y0 - 1 <= bb.y0 and bb.y1 <= fig.bbox.y1 + 1
+               for bb in (ax.get_tightbbox(renderer) for ax in fig.axes))
+
+def test_base_layout_follows_the_ticks_labels(tmp_path):
+    plot = Plot(dpi=20, fmt='png', workers=1)
+    fname = str(tmp_path / 'base')
+    plot.render_base('2024-01-01', blocks(1.0), fname)
+    fig = plot.layout('base')[0]
+    first = [ax.get_position().bounds for ax in fig.axes]
+    # same ticks labels, the layout is kept
+    plot.render_base('2024-01-01', blocks(1.0), fname)
+    assert [ax.get_position().bounds for ax in fig.axes] == first
+    # longer ticks labels and titles, the layout is solved again
+    plot.render_base('2024-01-01 12:00:00',
+                     blocks(123456.0), fname)
+    assert [ax.get_position().bounds for ax in fig.axes] != first
+    assert inside(fig)
+
+def test_base_layout_is_solved_once_for_new_windows(tmp_path, monkeypatch):
+    from matplotlib.layout_engine import ConstrainedLayoutEngine
+    solves = []
+    execute = ConstrainedLayoutEngine.execute
+
+    def counted(self, fig):
+        solves.append(fig)
+        return execute(self, fig)
+
+    monkeypatch.setattr(ConstrainedLayoutEngine, 'execute', counted)
+    plot = Plot(dpi=20, fmt='png', workers=1)
+    for i, dts in enumerate(['2024-01-01-06-00-00', '2024-01-01-06-15-00',
+                             '2024-01-02-11-45-00', '2024-02-10-17-30-00']):
+        plot.render_base(dts, blocks(1.0, seed=i), str(tmp_path / dts))
+    assert len(solves) == 1
+    assert inside(plot.layout('base')[0])
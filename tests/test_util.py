@@ -0,0 +1,20 @@
+from datetime import datetime
+
+import pytest
+
+from spectroman.util import get_range, in_hours
+
+def test_get_range():
+    assert get_range('2024-01-01', '2024-01-03') ==\
+        (datetime(2024, 1, 1), datetime(2024, 1, 3))
+    assert get_range(None, None, required=False) == (None, None)
+    with pytest.raises(ValueError):
+        get_range('2024-01-01', None)
+    with pytest.raises(ValueError):
+        get_range('2024-01-03', '2024-01-01')
+
+def test_in_hours_includes_both_bounds():
+    assert in_hours(datetime(2024, 1, 1, 6), 6, 18)
+    assert in_hours(datetime(2024, 1, 1, 18), 6, 18)
+    assert not in_hours(datetime(2024, 1, 1, 18, 0, 1), 6, 18)
+    assert not in_hours(datetime(2024, 1, 1, 5, 59), 6, 18)